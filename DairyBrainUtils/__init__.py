@@ -1,58 +1,577 @@
 import logging
 import sys
+import bisect
+import bz2
+import collections
+import collections.abc
 import csv
+import datetime
+import functools
+import gzip
+import hashlib
+import inspect
+import io
+import itertools
+import mmap
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+import psycopg2.extensions
+import psycopg2.extras
 from sqlalchemy import create_engine
-from sqlalchemy.sql import text
+from sqlalchemy.engine import URL
+from sqlalchemy.sql import bindparam, text
 
 logger = logging.getLogger(__name__)
-logger.setLevel('DEBUG')
+
+
+# process-wide registry of engines, keyed by normalized credentials (see _engine_key)
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def _engine_key(credentials):
+    """
+    Normalizes a credentials dictionary into a hashable key for the engine registry
+    :param credentials: Dictionary of credentials, as passed to get_engine
+    :return: A tuple that identifies the engine configuration
+    """
+    return (
+        str(credentials["dialect"]).lower(),
+        str(credentials["user"]),
+        str(credentials["password"]),
+        str(credentials["host"]).lower(),
+        str(credentials["port"]),
+        str(credentials["db_name"]),
+        bool(credentials.get("log", False)),
+        credentials.get("pool_size", 5),
+        credentials.get("max_overflow", 10),
+        bool(credentials.get("pre_ping", False)),
+        credentials.get("recycle", -1),
+        credentials.get("statement_timeout"),
+    )
 
 
 def get_engine(credentials):
     """
-    Use sqlalchemy to create an engine instance for future database connection
-    :param credentials: Dictionary with the following keys: [dialect, user, password, host, port, db_name, log]
+    Use sqlalchemy to create an engine instance for future database connection. Engines are cached per process, so
+    repeated calls with the same credentials return the same engine (and reuse its connection pool).
+    :param credentials: Dictionary with the following keys: [dialect, user, password, host, port, db_name, log], and
+    the optional pool keys: [pool_size, max_overflow, pre_ping, recycle, statement_timeout]
     :return: An engine instance
     """
-    try:
-        db_engine = create_engine(
-            credentials["dialect"]
-            + "://"
-            + credentials["user"]
-            + ":"
-            + credentials["password"]
-            + "@"
-            + credentials["host"]
-            + ":"
-            + credentials["port"]
-            + "/"
-            + credentials["db_name"],
-            echo=credentials["log"],
-        )
-    except:
-        logger.error("Can't connect to database: " + str(sys.exc_info()))
-        sys.exit(1)
+    key = _engine_key(credentials)
+    with _engines_lock:
+        db_engine = _engines.get(key)
+        if db_engine is not None:
+            return db_engine
+
+        connect_args = {}
+        if credentials.get("statement_timeout") is not None:
+            # statement_timeout is given in milliseconds
+            connect_args["options"] = "-c statement_timeout={}".format(int(credentials["statement_timeout"]))
+
+        try:
+            db_engine = create_engine(
+                URL.create(
+                    drivername=credentials["dialect"],
+                    username=credentials["user"],
+                    password=credentials["password"],
+                    host=credentials["host"],
+                    port=int(credentials["port"]),
+                    database=credentials["db_name"],
+                ),
+                echo=credentials["log"],
+                pool_size=credentials.get("pool_size", 5),
+                max_overflow=credentials.get("max_overflow", 10),
+                pool_pre_ping=credentials.get("pre_ping", False),
+                pool_recycle=credentials.get("recycle", -1),
+                connect_args=connect_args,
+            )
+        except:
+            logger.error("Can't connect to database: " + str(sys.exc_info()))
+            sys.exit(1)
+        _engines[key] = db_engine
     return db_engine
 
 
-def create_table_if_doesnt_exist(db_engine, table_name, sql_statement):
+def dispose_all(close=True):
+    """
+    Disposes every engine created by get_engine and empties the registry. Call this in a forked worker (with
+    close=False) so the child doesn't share the parent's pooled connections.
+    :param close: If False, pooled connections are dropped without being closed (use this right after a fork)
+    :return: None
+    """
+    with _engines_lock:
+        for db_engine in _engines.values():
+            db_engine.dispose(close=close)
+        _engines.clear()
+
+
+# metrics hook set with set_metrics_hook: (hook, slow_statement_seconds), or None when metrics are off
+_metrics = None
+# calls of instrumented helpers in progress, per thread (innermost last)
+_calls = threading.local()
+# statements that EXPLAIN accepts
+_explainable = re.compile(r"\s*(SELECT|INSERT|UPDATE|DELETE|WITH|VALUES)\b", re.IGNORECASE)
+# statements whose effects a rolled back savepoint doesn't undo: sequence and advisory lock functions, and INSERTs
+# (column defaults such as serial call nextval)
+_volatile = re.compile(r"\b(nextval|setval|pg_advisory_\w*|dblink\w*)\s*\(|^\s*INSERT\b", re.IGNORECASE)
+
+
+def set_metrics_hook(hook, slow_statement_seconds=None):
+    """
+    Sets the function that receives the metrics of the helpers of this module. Metrics are off (and cost nothing)
+    until a hook is set.
+    :param hook: Callable taking one dictionary per event, or None to turn metrics off. Each helper call sends
+    {"event": "call", "function", "seconds", "checkout_seconds", "round_trips", "rows", "bytes", "error"}, where rows
+    and bytes are those sent or received by COPY. A Metrics instance can be used as the hook.
+    :param slow_statement_seconds: If set, statements that take at least this long are run again with
+    EXPLAIN (ANALYZE, BUFFERS) inside a savepoint that is rolled back, and the hook receives
+    {"event": "slow_statement", "function", "statement", "seconds", "plan"}
+    :return: None
+    """
+    global _metrics
+    _metrics = None if hook is None else (hook, slow_statement_seconds)
+
+
+class _Call:
+    """
+    Counters of one call of an instrumented helper
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.checkout_seconds = 0.0
+        self.round_trips = 0
+        self.rows = 0
+        self.bytes = 0
+
+
+def _count(checkout_seconds=0.0, round_trips=0, rows=0, bytes=0):
+    """
+    Adds to the counters of the helper calls in progress in this thread (outer calls include their inner calls)
+    :return: None
+    """
+    for call in getattr(_calls, "stack", ()):
+        call.checkout_seconds += checkout_seconds
+        call.round_trips += round_trips
+        call.rows += rows
+        call.bytes += bytes
+
+
+def _emit(event):
+    """
+    Sends an event to the metrics hook. A failing hook is logged and doesn't fail the helper.
+    :param event: Dictionary
+    :return: None
+    """
+    metrics = _metrics
+    if metrics is not None:
+        try:
+            metrics[0](event)
+        except Exception as e:
+            logger.warning("Metrics hook failed: " + str(e))
+
+
+def _instrumented(func):
+    """
+    Decorator sending a "call" event to the metrics hook for each call of func (see set_metrics_hook)
+    :param func: Function (or generator function) to instrument
+    :return: The wrapped function
+    """
+    def start():
+        call = _Call(func.__name__)
+        if not hasattr(_calls, "stack"):
+            _calls.stack = []
+        _calls.stack.append(call)
+        return call, time.perf_counter()
+
+    def finish(call, started, error):
+        _calls.stack.remove(call)
+        _emit({"event": "call", "function": call.function, "seconds": time.perf_counter() - started,
+               "checkout_seconds": call.checkout_seconds, "round_trips": call.round_trips, "rows": call.rows,
+               "bytes": call.bytes, "error": error})
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _metrics is None:
+                return (yield from func(*args, **kwargs))
+            call, started = start()
+            error = True
+            try:
+                result = yield from func(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                finish(call, started, error)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _metrics is None:
+                return func(*args, **kwargs)
+            call, started = start()
+            error = True
+            try:
+                result = func(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                finish(call, started, error)
+    return wrapper
+
+
+class _MeteredFile:
+    """
+    Counts the bytes going through a file-like object used by COPY
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        _count(bytes=len(data))
+        return data
+
+    def readline(self, size=-1):
+        data = self.f.readline(size)
+        _count(bytes=len(data))
+        return data
+
+    def write(self, data):
+        _count(bytes=len(data))
+        return self.f.write(data)
+
+
+class _MeteredCursor(psycopg2.extensions.cursor):
+    """
+    DBAPI cursor counting round-trips and COPY rows and bytes, and capturing the plans of slow statements. Installed
+    on connections checked out with _checkout while a metrics hook is set.
+    """
+
+    def execute(self, query, vars=None):
+        if _metrics is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        result = super().execute(query, vars)
+        seconds = time.perf_counter() - started
+        _count(round_trips=1)
+        if _metrics is not None and _metrics[1] is not None and seconds >= _metrics[1]:
+            self._explain(self.query.decode("utf-8", "replace"), seconds)
+        return result
+
+    def executemany(self, query, vars_list):
+        if _metrics is None:
+            return super().executemany(query, vars_list)
+        vars_list = list(vars_list)
+        _count(round_trips=len(vars_list))
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        if _metrics is None:
+            return super().copy_expert(sql, file, size)
+        result = super().copy_expert(sql, _MeteredFile(file), size)
+        _count(round_trips=1, rows=max(self.rowcount, 0))
+        return result
+
+    def fetchmany(self, size=None):
+        if self.name is not None:  # server-side cursor: every fetch is a round-trip
+            _count(round_trips=1)
+        return super().fetchmany(size) if size is not None else super().fetchmany()
+
+    def _explain(self, statement, seconds):
+        """
+        Runs a slow statement again with EXPLAIN (ANALYZE, BUFFERS) inside a savepoint that is rolled back, and sends
+        its plan to the metrics hook. Statements with effects the rollback wouldn't undo (see _volatile) only get a
+        plain EXPLAIN, without being run again.
+        :param statement: The statement, with its parameters filled in
+        :param seconds: How long the statement took
+        :return: None
+        """
+        plan = None
+        single = statement.strip().rstrip(';')
+        if self.name is None and _explainable.match(single) and ';' not in single:
+            in_transaction = not self.connection.autocommit
+            cursor = psycopg2.extensions.cursor(self.connection)
+            try:
+                if in_transaction:
+                    cursor.execute("SAVEPOINT dairybrainutils_explain")
+                try:
+                    if _volatile.search(single):
+                        cursor.execute("EXPLAIN " + single)
+                        plan = "\n".join(row[0] for row in cursor.fetchall())
+                    elif in_transaction or single.lstrip()[:6].upper() == "SELECT":
+                        cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + single)
+                        plan = "\n".join(row[0] for row in cursor.fetchall())
+                finally:
+                    if in_transaction:
+                        cursor.execute("ROLLBACK TO SAVEPOINT dairybrainutils_explain")
+            except Exception as e:
+                logger.warning("Could not explain slow statement: " + str(e))
+            finally:
+                cursor.close()
+        stack = getattr(_calls, "stack", None)
+        _emit({"event": "slow_statement", "function": stack[-1].function if stack else None, "statement": statement,
+               "seconds": seconds, "plan": plan})
+
+
+def _checkout(db_engine):
+    """
+    Checks a connection out of the engine's pool, timing the wait and metering its cursors while a metrics hook is set
+    :param db_engine: Specifies the connection to the database
+    :return: A connection
+    """
+    if _metrics is None:
+        return db_engine.connect()
+    started = time.perf_counter()
+    con = db_engine.connect()
+    _count(checkout_seconds=time.perf_counter() - started)
+    dbapi_connection = con.connection.connection
+    if isinstance(dbapi_connection, psycopg2.extensions.connection):
+        dbapi_connection.cursor_factory = _MeteredCursor
+    return con
+
+
+class Metrics:
+    """
+    Metrics hook (see set_metrics_hook) that adds up the events it receives, for a summary at the end of a job
+    """
+
+    def __init__(self):
+        self.calls = collections.OrderedDict()
+        self.slow_statements = []
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        with self.lock:
+            if event["event"] == "slow_statement":
+                self.slow_statements.append(event)
+                return
+            totals = self.calls.get(event["function"])
+            if totals is None:
+                totals = self.calls[event["function"]] = dict.fromkeys(
+                    ("calls", "errors", "seconds", "checkout_seconds", "round_trips", "rows", "bytes"), 0)
+            totals["calls"] += 1
+            totals["errors"] += event["error"]
+            for key in ("seconds", "checkout_seconds", "round_trips", "rows", "bytes"):
+                totals[key] += event[key]
+
+    def report(self):
+        """
+        Formats the totals per helper (slowest first) and the slow statements
+        :return: String
+        """
+        with self.lock:
+            lines = ["{:<40} {:>7} {:>6} {:>10} {:>10} {:>8} {:>12} {:>14}".format(
+                "function", "calls", "errors", "seconds", "checkout", "trips", "rows", "bytes")]
+            for function, totals in sorted(self.calls.items(), key=lambda item: -item[1]["seconds"]):
+                lines.append("{:<40} {calls:>7} {errors:>6} {seconds:>10.3f} {checkout_seconds:>10.3f} "
+                             "{round_trips:>8} {rows:>12} {bytes:>14}".format(function, **totals))
+            for event in self.slow_statements:
+                lines.append("")
+                lines.append("Slow statement in {} ({:.3f}s): {}".format(event["function"], event["seconds"],
+                                                                         event["statement"]))
+                if event["plan"] is not None:
+                    lines.append(event["plan"])
+        return "\n".join(lines)
+
+
+# schema the helpers resolve unqualified table names in, per thread (see target_schema); dairy_comp by default
+_targets = threading.local()
+
+
+def _search_path():
+    """
+    Returns the search_path the helpers set on their connections
+    :return: String, e.g. 'dairy_comp, public'
+    """
+    return (getattr(_targets, "schema", None) or "dairy_comp") + ", public"
+
+
+@contextmanager
+def target_schema(schema_name):
+    """
+    Makes the helpers of this module called inside the block (by this thread) put schema_name instead of dairy_comp
+    first on their search_path, e.g. to load each farm into a schema of its own
+    :param schema_name: Name of the schema
+    :return: None
+    """
+    previous = getattr(_targets, "schema", None)
+    _targets.schema = schema_name
+    try:
+        yield
+    finally:
+        _targets.schema = previous
+
+
+def _in_target_schema(func):
+    """
+    Wraps func to run in the target schema of the calling thread, for work handed to a thread pool
+    :param func: Function
+    :return: The wrapped function
+    """
+    schema_name = getattr(_targets, "schema", None)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with target_schema(schema_name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# batches opened with batch(), per thread and keyed by engine
+_batches = threading.local()
+
+
+class Batch:
+    """
+    A single connection and transaction shared by the helpers of this module while a batch() block is active.
+    With pipeline=True, statements that don't return rows are queued and sent to the server in one round-trip
+    whenever a result is needed or the batch ends.
+    """
+
+    def __init__(self, db_engine, pipeline=False):
+        self.db_engine = db_engine
+        self.pipeline = pipeline
+        self.connection = None
+        self.transaction = None
+        self.pending = []
+
+    def execute(self, statement):
+        """
+        Queues a statement to be sent with the next flush
+        :param statement: String or sqlalchemy text clause
+        :return: None
+        """
+        self.pending.append(str(statement).strip().rstrip(';') + ';')
+
+    def flush(self):
+        """
+        Sends all queued statements to the database in a single round-trip
+        :return: None
+        """
+        if self.pending:
+            statements = "\n".join(self.pending)
+            self.pending = []
+            logger.debug("Flushing batch: " + statements)
+            try:
+                # go through the DBAPI cursor so the statements are sent verbatim
+                self.connection.connection.cursor().execute(statements)
+            except Exception as e:
+                logger.error("Error executing batched statements {}".format(statements))
+                logger.error(e.args)
+                exit(1)
+
+
+def _active_batch(db_engine):
+    """
+    Returns the batch opened on db_engine by the current thread, or None
+    :param db_engine: Specifies the connection to the database
+    :return: A Batch instance or None
+    """
+    return getattr(_batches, "open", {}).get(id(db_engine))
+
+
+@contextmanager
+def batch(db_engine, pipeline=False):
+    """
+    Runs every helper of this module that is called on db_engine inside the block on one connection, and commits
+    them as one transaction when the block exits (or rolls them back if it raises)
+    :param db_engine: Specifies the connection to the database
+    :param pipeline: If True, statements that don't return rows are sent together in as few round-trips as possible
+    :return: A Batch instance
+    """
+    current = _active_batch(db_engine)
+    if current is not None:  # nested batch on the same engine: join the outer one
+        yield current
+        return
+
+    current = Batch(db_engine, pipeline)
+    if not hasattr(_batches, "open"):
+        _batches.open = {}
+    with _checkout(db_engine) as con:
+        current.connection = con
+        current.transaction = con.begin()
+        _batches.open[id(db_engine)] = current
+        try:
+            yield current
+            current.flush()
+        except BaseException:
+            current.transaction.rollback()
+            refresh_catalog(db_engine)  # tables created or dropped in the batch are gone
+            raise
+        else:
+            try:
+                current.transaction.commit()
+            except Exception as e:
+                logger.error("Error committing batch in " + db_engine.url.database + " database!")
+                logger.error(e.args)
+                exit(1)
+        finally:
+            del _batches.open[id(db_engine)]
+
+
+@contextmanager
+def _connect(db_engine, pipelined=False):
+    """
+    Yields the connection of the batch active on db_engine, or a new connection if there is none
+    :param db_engine: Specifies the connection to the database
+    :param pipelined: If True and the active batch is pipelined, yields the batch itself so statements get queued
+    :return: A connection (or Batch) with an execute() method
+    """
+    current = _active_batch(db_engine)
+    if current is None:
+        with _checkout(db_engine) as con:
+            yield con
+    elif pipelined and current.pipeline:
+        yield current
+    else:
+        current.flush()
+        yield current.connection
+
+
+def _partitioned(sql_statement, partition_by):
+    """
+    Adds a PARTITION BY clause to a CREATE TABLE statement
+    :param sql_statement: CREATE TABLE statement
+    :param partition_by: Partitioning, e.g. "RANGE (event_date)", or None
+    :return: The statement
+    """
+    if partition_by is None:
+        return sql_statement
+    return sql_statement.strip().rstrip(';') + " PARTITION BY " + partition_by + ";"
+
+
+@_instrumented
+def create_table_if_doesnt_exist(db_engine, table_name, sql_statement, partition_by=None):
     """
     Creates a table with table_name in the database if a table with the given name doesn't exist.
     :param db_engine: Specifies the connection to the database
     :param table_name: Name of the table that needs to be created
     :param sql_statement: SQL statement with the column headers of the table. They are strings that are stored in the
     animal_import and event_import scripts.
+    :param partition_by: Optional partitioning of the table, e.g. "RANGE (event_date)" or "LIST (herd_id)"; see
+    create_range_partitions and create_list_partitions for creating its partitions
     :return: None
     """
+    sql_statement = _partitioned(sql_statement, partition_by)
     # check and delete if table already exists
     if not has_table(table_name, db_engine):
         logger.debug("Table {} not found - creating...".format(table_name))
 
-        with db_engine.connect() as con:
+        with _connect(db_engine, pipelined=True) as con:
             try:
                 logger.info("Creating table " + table_name + " in " + db_engine.url.database + " database...")
                 logger.debug('create_temp_table_statement = ' + str(sql_statement.format(table_name)))
                 con.execute(str(sql_statement.format(table_name)))
+                _update_catalog(db_engine, table_name, True)
             except Exception as e:
                 print("The exception is " + str(e))
                 logger.error("Error creating the table " + table_name + " in " + db_engine.url.database + " database!")
@@ -60,24 +579,29 @@ def create_table_if_doesnt_exist(db_engine, table_name, sql_statement):
                 exit(1)
 
 
-def create_table(db_engine, table_name, sql_statement):
+@_instrumented
+def create_table(db_engine, table_name, sql_statement, partition_by=None):
     """
     Creates a table with table_name in the database.
     :param db_engine: Specifies the connection to the database
     :param table_name: Name of the table that needs to be created
     :param sql_statement: SQL statement with the column headers of the table. They are strings that are stored in the
     animal_import and event_import scripts.
+    :param partition_by: Optional partitioning of the table, e.g. "RANGE (event_date)" or "LIST (herd_id)"; see
+    create_range_partitions and create_list_partitions for creating its partitions
     :return: None
     """
+    sql_statement = _partitioned(sql_statement, partition_by)
     # check and delete if table already exists
     drop_table(table_name, db_engine)
 
     # create new temp table
-    with db_engine.connect() as con:
+    with _connect(db_engine, pipelined=True) as con:
         try:
             logger.info("Creating table " + table_name + " in " + db_engine.url.database + " database...")
             logger.debug('create_temp_table_statement = ' + str(sql_statement.format(table_name)))
             con.execute(str(sql_statement.format(table_name)))
+            _update_catalog(db_engine, table_name, True, partitioned=partition_by is not None)
         except Exception as e:
             print("The exception is " + str(e))
             logger.error("Error creating the table " + table_name + " in " + db_engine.url.database + " database!")
@@ -85,6 +609,7 @@ def create_table(db_engine, table_name, sql_statement):
             exit(1)
 
 
+@_instrumented
 def create_schema(db_engine, schema_name):
     """
     Creates a schema in the database
@@ -92,7 +617,7 @@ def create_schema(db_engine, schema_name):
     :param schema_name: Name of the schema to be created
     :return: None
     """
-    with db_engine.connect() as con:
+    with _connect(db_engine, pipelined=True) as con:
         try:
             logger.info("Creating schema " + schema_name)
             con.execute(text("CREATE SCHEMA IF NOT EXISTS " + schema_name + ";"))
@@ -103,6 +628,7 @@ def create_schema(db_engine, schema_name):
             exit(1)
 
 
+@_instrumented
 def create_sequence(db_engine, sequence_name):
     """
     Creates a sequence in the database
@@ -110,10 +636,11 @@ def create_sequence(db_engine, sequence_name):
     :param sequence_name: Name of the sequence to be created
     :return: None
     """
-    with db_engine.connect() as con:
+    with _connect(db_engine, pipelined=True) as con:
         try:
             logger.info("Creating sequence " + sequence_name)
             con.execute(text("CREATE SEQUENCE IF NOT EXISTS " + sequence_name + ";"))
+            _update_catalog(db_engine, sequence_name, True)
         except Exception as e:
             print("The exception is " + str(e))
             logger.error("Error creating the sequence " + sequence_name)
@@ -121,16 +648,33 @@ def create_sequence(db_engine, sequence_name):
             exit(1)
 
 
-def get_next_from_sequence(db_engine, sequence_name):
+# ids fetched ahead of time by get_next_from_sequence, keyed by (engine, sequence name)
+_id_blocks = {}
+_id_blocks_lock = threading.Lock()
+
+
+@_instrumented
+def get_next_from_sequence(db_engine, sequence_name, block_size=1):
     """
     Returns the next id in the given sequence (assuming one exists)
     :param db_engine: Specifies the connection to the database
     :param sequence_name: Name of the sequence to be created
-    :return: None
+    :param block_size: If greater than 1, ids are fetched from the database block_size at a time and handed out from
+    a process-wide cache. Ids left in the cache when the process ends are never used.
+    :return: The next id
     """
+    if block_size > 1:
+        key = (id(db_engine), sequence_name)
+        with _id_blocks_lock:
+            block = _id_blocks.get(key)
+            if not block:
+                block = _id_blocks[key] = collections.deque(
+                    get_ids_from_sequence(db_engine, sequence_name, block_size))
+            return block.popleft()
+
     query_sequence_statement = text("SELECT nextval(\'" + sequence_name + "\');")
 
-    with db_engine.connect() as con:
+    with _connect(db_engine) as con:
         try:
             logger.info("Creating query_sequence_statement...")
             # Optional error checking here to check if the sequence exists
@@ -146,83 +690,2168 @@ def get_next_from_sequence(db_engine, sequence_name):
             exit(1)
 
 
-def populate_table_from_csv(table_name, csv_location, db_engine):
+@_instrumented
+def get_ids_from_sequence(db_engine, sequence_name, n):
+    """
+    Returns the next n ids in the given sequence (assuming one exists), using a single query
+    :param db_engine: Specifies the connection to the database
+    :param sequence_name: Name of the sequence
+    :param n: Number of ids wanted
+    :return: List of n ids, in increasing order
+    """
+    query_sequence_statement = text("SELECT nextval(:sequence_name) FROM generate_series(1, :n);")
+
+    with _connect(db_engine) as con:
+        try:
+            logger.info("Getting " + str(n) + " ids from sequence " + sequence_name + "...")
+            result = con.execute(query_sequence_statement, sequence_name=sequence_name, n=n)
+            return sorted(row[0] for row in result)
+        except Exception as e:
+            logger.error("Error getting ids from sequence " + sequence_name + "!")
+            logger.error(e)
+            exit(1)
+
+
+# compressed formats read by _open_csv: (name, magic bytes, file name extensions)
+_compressions = (
+    ("gzip", b"\x1f\x8b", (".gz", ".gzip")),
+    ("bz2", b"BZh", (".bz2",)),
+    ("zstd", b"\x28\xb5\x2f\xfd", (".zst", ".zstd")),
+)
+
+
+def _compression(file_name, check_content=True):
+    """
+    Tells how a file is compressed, from its first bytes or else from its extension
+    :param file_name: Location of the file
+    :param check_content: If False, only the extension is looked at (e.g. for a file about to be written)
+    :return: 'gzip', 'bz2', 'zstd' or None
+    """
+    if check_content and os.path.exists(file_name):
+        with open(file_name, 'rb') as f:
+            head = f.read(4)
+        for name, magic, extensions in _compressions:
+            if head.startswith(magic):
+                return name
+        if head:
+            return None
+    for name, magic, extensions in _compressions:
+        if file_name.lower().endswith(extensions):
+            return name
+    return None
+
+
+def _open_compressed(file_name, compression, mode):
+    """
+    Opens a compressed file, decompressing (or compressing) it on the fly
+    :param file_name: Location of the file
+    :param compression: 'gzip', 'bz2' or 'zstd'
+    :param mode: 'rb', 'rt', 'wb' or 'wt'
+    :return: File object
+    """
+    if compression == "gzip":
+        # level 1: compression keeps up with the writer instead of being the bottleneck
+        return gzip.open(file_name, mode, compresslevel=1) if mode[0] == 'w' else gzip.open(file_name, mode)
+    if compression == "bz2":
+        return bz2.open(file_name, mode)
+    import zstandard  # only needed for zstd files
+    if mode == 'rb':  # zstandard's reader has no readline()
+        return io.BufferedReader(zstandard.open(file_name, mode), 1 << 20)
+    return zstandard.open(file_name, mode)
+
+
+def _open_csv(csv_location, binary=True):
+    """
+    Opens a csv file for reading. Compressed files (gzip, bz2 or zstd, told apart by their first bytes or their
+    extension) are decompressed on the fly; uncompressed files are memory-mapped when read in binary mode.
+    :param csv_location: Location of the csv file
+    :param binary: If True, the file yields bytes (enough for COPY, which gets the rows undecoded); otherwise str
+    :return: File-like object with read() and readline() methods, usable as a context manager
+    """
+    compression = _compression(csv_location)
+    if compression is not None:
+        return _open_compressed(csv_location, compression, 'rb' if binary else 'rt')
+    if not binary:
+        return open(csv_location, 'r')
+    with open(csv_location, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty files can't be mapped
+            return open(csv_location, 'rb')
+
+
+def _open_output(file_name):
+    """
+    Opens a file for writing text, compressed on the fly if its extension is .gz, .bz2 or .zst
+    :param file_name: Location of the file
+    :return: File object
+    """
+    compression = _compression(file_name, check_content=False)
+    if compression is not None:
+        return _open_compressed(file_name, compression, 'wt')
+    return open(file_name, "w+")
+
+
+def _copy_from(cursor, f, table_name):
+    """
+    Copies comma separated rows from a file-like object into a table. Unlike cursor.copy_from, this accepts
+    schema.table_name.
+    :param cursor: DBAPI cursor
+    :param f: File-like object with read() and readline() methods
+    :param table_name: Name of the table that needs to be populated
+    :return: None
+    """
+    cursor.copy_expert("COPY {} FROM STDIN WITH (DELIMITER ',', NULL '');".format(table_name), f)
+
+
+@_instrumented
+def populate_table_from_csv(table_name, csv_location, db_engine, max_rejects=None, reject_location=None,
+                            reject_table=None, batch_rows=50000):
     """
     Populates a table with the contents of a csv file
     :param table_name: Name of the table that needs to be populated
-    :param csv_location: Location of the csv file
+    :param csv_location: Location of the csv file; gzip, bz2 and zstd files are decompressed on the fly
     :param db_engine: Specifies the connection to the database
+    :param max_rejects: If given, rows the database refuses are set aside instead of failing the whole load, as long
+    as there are at most max_rejects of them (see _copy_tolerant)
+    :param reject_location: With max_rejects, the file the refused rows are written to, with their line number and
+    error (defaults to csv_location + '.rejects')
+    :param reject_table: With max_rejects, optional table the refused rows are also recorded in (created if it doesn't
+    exist)
+    :param batch_rows: With max_rejects, number of rows copied at a time
+    :return: Number of rows copied, or with max_rejects a dictionary with the keys: [rows, rejected]
+    """
+    try:
+        with _open_csv(csv_location) as f:
+            if not f.readline():  # Skip the header row.
+                raise EOFError("empty file")
+            if max_rejects is None:
+                return populate_table_from_stream(table_name, f, db_engine, csv_location)
+            with open(reject_location or csv_location + ".rejects", "w") as rejects:
+                return _copy_tolerant(table_name, f, db_engine, csv_location, max_rejects, rejects, reject_table,
+                                      batch_rows)
+    except (OSError, EOFError) as e:
+        logger.error(
+            "Error importing the table " + table_name + " in " + db_engine.url.database +
+            " database from " + csv_location + "!")
+        logger.error(e.args)
+        exit(1)
+
+
+def _create_reject_table(cursor, reject_table):
+    """
+    Creates the table refused rows are recorded in, if it doesn't exist
+    :param cursor: DBAPI cursor
+    :param reject_table: Name of the reject table
     :return: None
     """
-    # 'copy_from' example from https://www.dataquest.io/blog/loading-data-into-postgres/
-    # adapted to sqlalchemy using https://stackoverflow.com/questions/13125236/sqlalchemy-psycopg2-and-postgresql-copy
-    with db_engine.connect() as con:
-        # isolate a connection
-        connection = db_engine.connect().connection
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS {} ("
+        "table_name text NOT NULL, "
+        "source text NOT NULL, "
+        "line_number bigint NOT NULL, "
+        "line text NOT NULL, "
+        "error text, "
+        "rejected_at timestamptz NOT NULL DEFAULT now());".format(reject_table))
 
-        # get the cursor
+
+def _copy_tolerant(table_name, f, db_engine, source, max_rejects, rejects, reject_table=None, batch_rows=50000):
+    """
+    Copies the rows of a file-like object into a table batch by batch, each in a savepoint. When a batch fails it is
+    split in halves that are copied again, down to the single rows that fail, which are set aside; the other rows are
+    kept. Everything is committed in one transaction at the end.
+    :param table_name: Name of the table that needs to be populated
+    :param f: File-like object positioned after the header row, returning bytes
+    :param db_engine: Specifies the connection to the database
+    :param source: Name of the file, used in log messages and reject records
+    :param max_rejects: Number of refused rows tolerated; one more and the load fails and is rolled back
+    :param rejects: Text file the refused rows are written to, as line number, error and row separated by tabs
+    :param reject_table: Optional table the refused rows are also recorded in
+    :param batch_rows: Number of rows copied at a time
+    :return: Dictionary with the keys: [rows, rejected]
+    """
+    counts = {"rows": 0, "rejected": 0}
+
+    with _connect(db_engine) as con:
+        connection = con.connection
         cursor = connection.cursor()
-        #import pdb; pdb.set_trace()
+
+        def copy(lines):
+            # lines: list of (line number, bytes)
+            cursor.execute("SAVEPOINT dairybrainutils_batch")
+            try:
+                _copy_from(cursor, io.BytesIO(b"".join(line for _, line in lines)), table_name)
+            except psycopg2.Error as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT dairybrainutils_batch")
+                # ROLLBACK TO keeps the savepoint; released here, failed batches would pile up subtransactions
+                cursor.execute("RELEASE SAVEPOINT dairybrainutils_batch")
+                if len(lines) > 1:
+                    half = len(lines) // 2
+                    copy(lines[:half])
+                    copy(lines[half:])
+                    return
+                line_number, line = lines[0]
+                error = (e.pgerror or str(e)).strip()
+                counts["rejected"] += 1
+                if counts["rejected"] > max_rejects:
+                    raise ValueError("More than {} rejected rows, the last one at line {}: {}".format(
+                        max_rejects, line_number, error))
+                row = line.decode("utf-8", "replace").rstrip("\r\n")
+                logger.warning("Rejected line " + str(line_number) + " of " + source + ": " + error.splitlines()[0])
+                rejects.write("{}\t{}\t{}\n".format(line_number, error.splitlines()[0], row))
+                if reject_table is not None:
+                    cursor.execute("INSERT INTO {} (table_name, source, line_number, line, error) "
+                                   "VALUES (%s, %s, %s, %s, %s);".format(reject_table),
+                                   (table_name, source, line_number, row, error))
+            else:
+                cursor.execute("RELEASE SAVEPOINT dairybrainutils_batch")
+                counts["rows"] += len(lines)
 
         try:
-            cursor.execute('SET search_path TO dairy_comp, public')
-            with open(csv_location, 'r') as f:
-                next(f)  # Skip the header row.
-                cursor.copy_from(f, table_name, sep=',', null='')
-            connection.commit()
+            cursor.execute('SET LOCAL search_path TO ' + _search_path())
+            if reject_table is not None:
+                _create_reject_table(cursor, reject_table)
+            lines = enumerate(iter(f.readline, b""), 2)  # line 1 is the header row
+            for batch_lines in iter(lambda: list(itertools.islice(lines, batch_rows)), []):
+                copy(batch_lines)
+            if _active_batch(db_engine) is None:  # a batch commits on its own
+                connection.commit()
 
         except Exception as e:
             logger.error(
                 "Error importing the table " + table_name + " in " + db_engine.url.database +
-                " database from " + csv_location + "!")
+                " database from " + source + "!")
             logger.error(e.args)
             exit(1)
 
+    if counts["rejected"]:
+        logger.warning("Rejected " + str(counts["rejected"]) + " rows of " + source + " (see " + rejects.name + ")")
+    return counts
+
 
-def execute_statement(statement, db_engine):
+@_instrumented
+def populate_table_from_stream(table_name, stream, db_engine, source="stream"):
     """
-    Executes a SQL statement in the database
-    :param statement: String; SQL statement
+    Populates a table with the rows read from a file-like object (without a header row)
+    :param table_name: Name of the table that needs to be populated
+    :param stream: File-like object with read() and readline() methods, returning comma separated rows
     :param db_engine: Specifies the connection to the database
-    :return: None
+    :param source: Name of the stream, used in log messages
+    :return: Number of rows copied
     """
-    with db_engine.connect() as con:
+    # 'copy_from' example from https://www.dataquest.io/blog/loading-data-into-postgres/
+    # adapted to sqlalchemy using https://stackoverflow.com/questions/13125236/sqlalchemy-psycopg2-and-postgresql-copy
+    with _connect(db_engine) as con:
+        # isolate a connection
+        connection = con.connection
+
+        # get the cursor
+        cursor = connection.cursor()
+
         try:
-            con.execute(text(statement))
+            cursor.execute('SET LOCAL search_path TO ' + _search_path())
+            _copy_from(cursor, stream, table_name)
+            rows = cursor.rowcount
+            if _active_batch(db_engine) is None:  # a batch commits on its own
+                connection.commit()
+
         except Exception as e:
-            logger.error("Error executing statement {}".format(statement))
+            logger.error(
+                "Error importing the table " + table_name + " in " + db_engine.url.database +
+                " database from " + source + "!")
             logger.error(e.args)
             exit(1)
 
+    return rows
 
-def drop_table(table_name, db_engine):
+
+class _FileRange:
     """
-    Drops a table from the database
-    :param table_name: Name of the table that needs to be dropped
-    :param db_engine: Specifies the connection to the database
-    :return: None
+    Read-only file-like view over the bytes [start, end) of a file, for cursor.copy_from
     """
-    if has_table(table_name, db_engine):
-        logger.debug("Deleting old (pre-existing) table: " + table_name + "...")
-        statement = str("DROP TABLE IF EXISTS {};")
 
-        with db_engine.connect() as con:
-            try:
-                con.execute(statement.format(table_name))
-            except Exception as e:
-                logger.error("Error deleting table " + table_name + " from database!")
-                logger.error(e.args)
-                exit(1)
+    def __init__(self, f, start, end):
+        self.f = f
+        self.remaining = end - start
+        self.f.seek(start)
 
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
 
-def has_table(table_name, db_engine):
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.readline(size)
+        self.remaining -= len(data)
+        return data
+
+
+def _split_csv(csv_location, chunks, block_size=1 << 20, start=None):
     """
-    Checks if a table with table_name is in the database
-    :param table_name: Name of the table that needs to be checked
+    Splits a csv file (minus its header row) into byte ranges of roughly equal size. Ranges only end on a newline
+    that is outside of a quoted field, so every range holds whole rows.
+    :param csv_location: Location of the csv file
+    :param chunks: Number of ranges wanted
+    :param block_size: Number of bytes read at a time while scanning the file
+    :param start: Optional offset to split from instead of the end of the header row; must be the start of a row
+    :return: List of (start, end) byte offsets
+    """
+    size = os.path.getsize(csv_location)
+    with open(csv_location, 'rb') as f:
+        if start is None:
+            f.readline()  # Skip the header row.
+            start = f.tell()
+        else:
+            f.seek(start)
+        targets = [start + (size - start) * i // chunks for i in range(1, chunks)]
+
+        # scan the whole file to keep track of quotes, since a newline inside quotes is not a row boundary
+        boundaries = [start]
+        in_quotes = False
+        offset = start
+        block = f.read(block_size)
+        while block and targets:
+            pos = 0
+            while targets and offset + len(block) > targets[0]:
+                newline = block.find(b'\n', max(pos, targets[0] - offset))
+                if newline == -1:
+                    break
+                in_quotes ^= block.count(b'"', pos, newline) % 2 == 1
+                pos = newline + 1
+                if not in_quotes:
+                    if offset + pos > boundaries[-1]:
+                        boundaries.append(offset + pos)
+                    targets.pop(0)
+            in_quotes ^= block.count(b'"', pos) % 2 == 1
+            offset += len(block)
+            block = f.read(block_size)
+    boundaries.append(size)
+    return [(boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1) if boundaries[i] < boundaries[i + 1]]
+
+
+@_instrumented
+def _copy_range(table_name, csv_location, start, end, db_engine, before_commit=None):
+    """
+    Copies the rows in the byte range [start, end) of a csv file into a table, on a connection of its own. Compressed
+    files can't be cut into byte ranges: for those, only the whole file (0 to its size) can be copied, decompressed
+    and without its header row.
+    :param table_name: Name of the table that needs to be populated
+    :param csv_location: Location of the csv file
+    :param start: Offset of the first byte to copy
+    :param end: Offset after the last byte to copy
     :param db_engine: Specifies the connection to the database
-    :return: True if table with table_name is in the database, False otherwise
+    :param before_commit: Optional function called with (cursor, rows, seconds) in the same transaction as the copy
+    :return: Dictionary with the keys: [rows, bytes, seconds, rows_per_sec]
+    """
+    started = time.perf_counter()
+    compressed = _compression(csv_location) is not None
+    if compressed and (start, end) != (0, os.path.getsize(csv_location)):
+        raise ValueError("Can't copy a byte range of the compressed file " + csv_location + ", only all of it")
+    with _checkout(db_engine) as con:
+        connection = con.connection
+        cursor = connection.cursor()
+        cursor.execute('SET LOCAL search_path TO ' + _search_path())
+        if compressed:
+            with _open_csv(csv_location) as f:
+                f.readline()  # Skip the header row.
+                _copy_from(cursor, f, table_name)
+        else:
+            with open(csv_location, 'rb') as f:
+                _copy_from(cursor, _FileRange(f, start, end), table_name)
+        rows = cursor.rowcount
+        if before_commit is not None:
+            before_commit(cursor, rows, time.perf_counter() - started)
+        connection.commit()
+    seconds = time.perf_counter() - started
+    return {"rows": rows, "bytes": end - start, "seconds": seconds, "rows_per_sec": rows / seconds if seconds else 0.0}
+
+
+@_instrumented
+def populate_table_from_csv_parallel(table_name, csv_location, db_engine, workers=4):
+    """
+    Populates a table with the contents of a csv file, copying chunks of the file straight into the table concurrently
+    over several connections. The workers only commit once every chunk is copied, so a failed chunk rolls back all of
+    them; should a commit itself fail after others went through, the committed rows are deleted again (by their xmin).
+    Inside a batch(), or if the file is compressed (its bytes can't be split into rows), the file is copied serially
+    instead.
+    :param table_name: Name of the table that needs to be populated
+    :param csv_location: Location of the csv file
+    :param db_engine: Specifies the connection to the database
+    :param workers: Number of concurrent connections (the engine's pool should allow at least this many)
+    :return: List with one dictionary per worker, with the keys: [rows, bytes, seconds, rows_per_sec] (empty if the
+    file has no rows)
+    """
+    # the workers would need connections of their own, which can't see (or wait for) a batch's transaction
+    in_batch = _active_batch(db_engine) is not None
+    if in_batch or _compression(csv_location) is not None:
+        logger.info("Copying " + csv_location + " into " + table_name + " serially, " +
+                    ("inside the active batch" if in_batch else "since it is compressed"))
+        started = time.perf_counter()
+        rows = populate_table_from_csv(table_name, csv_location, db_engine)
+        seconds = time.perf_counter() - started
+        return [{"rows": rows, "bytes": os.path.getsize(csv_location), "seconds": seconds,
+                 "rows_per_sec": rows / seconds if seconds else 0.0}]
+
+    ranges = _split_csv(csv_location, workers)
+    if not ranges:  # only a header row
+        logger.info("No rows to copy from " + csv_location)
+        return []
+    logger.info("Copying " + csv_location + " into " + table_name + " in " + str(len(ranges)) + " chunks...")
+    # every worker waits here with its chunk copied but not committed, until all chunks are copied
+    copied = threading.Barrier(len(ranges))
+    committed_xids = []
+    xids_lock = threading.Lock()
+
+    def before_commit(cursor, rows, seconds):
+        cursor.execute("SELECT txid_current() % 4294967296;")
+        xid = cursor.fetchone()[0]
+        copied.wait()  # raises BrokenBarrierError if another chunk failed
+        with xids_lock:  # recorded before the commit, in case a later commit fails
+            committed_xids.append(xid)
+
+    def copy_range(start, end):
+        try:
+            return _copy_range(table_name, csv_location, start, end, db_engine, before_commit)
+        except BaseException:
+            copied.abort()  # release the workers waiting to commit, so they roll back
+            raise
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(_in_target_schema(copy_range), start, end) for start, end in ranges]
+            errors = [future.exception() for future in futures]
+            # report the chunk that failed, rather than the workers it made give up
+            error = next((e for e in errors if e is not None and not isinstance(e, threading.BrokenBarrierError)),
+                         next((e for e in errors if e is not None), None))
+            if error is not None:
+                raise error
+            stats = [future.result() for future in futures]
+    except Exception as e:
+        logger.error(
+            "Error importing the table " + table_name + " in " + db_engine.url.database +
+            " database from " + csv_location + "!")
+        logger.error(e.args)
+        if committed_xids:
+            # some workers committed before another one's commit failed
+            with _checkout(db_engine) as con:
+                with con.begin():
+                    con.execute("SET LOCAL search_path TO " + _search_path())
+                    con.execute(text("DELETE FROM {} WHERE xmin::text::bigint IN :xids;".format(table_name))
+                                .bindparams(bindparam("xids", expanding=True)), {"xids": committed_xids})
+        exit(1)
+
+    for worker, worker_stats in enumerate(stats):
+        logger.info("Worker {}: {} rows in {:.2f}s ({:.0f} rows/sec)".format(
+            worker, worker_stats["rows"], worker_stats["seconds"], worker_stats["rows_per_sec"]))
+    return stats
+
+
+def _quote(identifier):
+    """
+    Quotes a column name for use in a SQL statement
+    :param identifier: Column name
+    :return: The quoted column name
     """
-    if '.' in table_name:  # received schema.table_name
-        return db_engine.has_table(table_name.split('.')[1], schema=table_name.split('.')[0])
-    else:  # received plain table_name
-        return db_engine.has_table(table_name)
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def _table_columns(cursor, table_name):
+    """
+    Returns the column names of a table, in order
+    :param cursor: DBAPI cursor
+    :param table_name: Name of the table (table_name or schema.table_name)
+    :return: List of column names
+    """
+    cursor.execute(
+        "SELECT attname FROM pg_catalog.pg_attribute "
+        "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum;", (table_name,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+@_instrumented
+def upsert_from_csv(table_name, csv_location, key_columns, db_engine, delete_missing=False):
+    """
+    Merges the contents of a csv file into a table: new rows are inserted, changed rows are updated and unchanged
+    rows are left alone, so they don't produce dead tuples. The table needs a unique index on key_columns.
+    :param table_name: Name of the table that needs to be populated
+    :param csv_location: Location of the csv file, with the same columns as the table
+    :param key_columns: List of the columns that identify a row
+    :param db_engine: Specifies the connection to the database
+    :param delete_missing: If True, rows of the table whose key is not in the csv file are deleted
+    :return: Dictionary with the keys: [rows, inserted, updated, unchanged, deleted]
+    """
+    staging_table = "upsert_staging"
+
+    with _connect(db_engine) as con:
+        connection = con.connection
+        cursor = connection.cursor()
+
+        try:
+            cursor.execute('SET LOCAL search_path TO ' + _search_path())
+            columns = _table_columns(cursor, table_name)
+            other_columns = [column for column in columns if column not in key_columns]
+
+            # temporary tables are never WAL-logged, and this one goes away with the transaction
+            cursor.execute("CREATE TEMPORARY TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP;".format(
+                staging_table, table_name))
+            with _open_csv(csv_location) as f:
+                f.readline()  # Skip the header row.
+                _copy_from(cursor, f, staging_table)
+            rows = cursor.rowcount
+
+            column_list = ", ".join(_quote(column) for column in columns)
+            key_list = ", ".join(_quote(column) for column in key_columns)
+            if other_columns:
+                target = ", ".join("t." + _quote(column) for column in other_columns)
+                source = ", ".join("EXCLUDED." + _quote(column) for column in other_columns)
+                on_conflict = "DO UPDATE SET ({}) = ROW({}) WHERE ROW({}) IS DISTINCT FROM ROW({})".format(
+                    ", ".join(_quote(column) for column in other_columns), source, target, source)
+            else:
+                on_conflict = "DO NOTHING"
+            # xmax is 0 for freshly inserted rows, which tells inserts from updates
+            cursor.execute(
+                "WITH merged AS (INSERT INTO {} AS t ({}) SELECT {} FROM {} ON CONFLICT ({}) {} "
+                "RETURNING (t.xmax = 0) AS inserted) "
+                "SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM merged;".format(
+                    table_name, column_list, column_list, staging_table, key_list, on_conflict))
+            inserted, updated = cursor.fetchone()
+
+            deleted = 0
+            if delete_missing:
+                cursor.execute("DELETE FROM {} AS t WHERE NOT EXISTS (SELECT 1 FROM {} AS s WHERE {});".format(
+                    table_name, staging_table,
+                    " AND ".join("s.{0} = t.{0}".format(_quote(column)) for column in key_columns)))
+                deleted = cursor.rowcount
+
+            if _active_batch(db_engine) is None:  # a batch commits on its own
+                connection.commit()
+            else:
+                cursor.execute("DROP TABLE {};".format(staging_table))
+
+        except Exception as e:
+            logger.error(
+                "Error merging " + csv_location + " into the table " + table_name + " in " + db_engine.url.database +
+                " database!")
+            logger.error(e.args)
+            exit(1)
+
+    logger.info("Merged {} rows into {}: {} inserted, {} updated, {} deleted".format(
+        rows, table_name, inserted, updated, deleted))
+    return {"rows": rows, "inserted": inserted, "updated": updated, "unchanged": rows - inserted - updated,
+            "deleted": deleted}
+
+
+@_instrumented
+def create_manifest_table(db_engine, manifest_table="public.load_manifest"):
+    """
+    Creates the table that load_files uses to remember which files (and chunks of files) are loaded, if it doesn't
+    exist
+    :param db_engine: Specifies the connection to the database
+    :param manifest_table: Name of the manifest table
+    :return: None
+    """
+    # chunk -1 is the row for the whole file, written once all of its chunks are loaded
+    create_table_if_doesnt_exist(db_engine, manifest_table, """
+        CREATE TABLE {} (
+            table_name text NOT NULL,
+            file_path text NOT NULL,
+            chunk integer NOT NULL,
+            start_offset bigint NOT NULL,
+            end_offset bigint NOT NULL,
+            size bigint NOT NULL,
+            mtime double precision NOT NULL,
+            content_hash text NOT NULL,
+            rows bigint,
+            status text NOT NULL,
+            error text,
+            loaded_at timestamp with time zone NOT NULL DEFAULT now(),
+            seconds double precision,
+            PRIMARY KEY (table_name, file_path, chunk)
+        );
+    """)
+
+
+def _file_hash(csv_location, start=0, end=None, block_size=1 << 20):
+    """
+    Returns the sha256 of a file's content, or of the bytes [start, end) of it
+    :param csv_location: Location of the file
+    :param start: Offset of the first byte to hash
+    :param end: Offset after the last byte to hash, or None for the end of the file
+    :param block_size: Number of bytes read at a time
+    :return: Hex digest
+    """
+    if end is None:
+        end = os.path.getsize(csv_location)
+    digest = hashlib.sha256()
+    with open(csv_location, 'rb') as f:
+        stream = _FileRange(f, start, end)
+        for block in iter(lambda: stream.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _record_manifest(cursor, manifest_table, values):
+    """
+    Inserts (or replaces) one row of the manifest table
+    :param cursor: DBAPI cursor
+    :param manifest_table: Name of the manifest table
+    :param values: Dictionary with the columns of the row
+    :return: None
+    """
+    columns = ["table_name", "file_path", "chunk", "start_offset", "end_offset", "size", "mtime",
+               "content_hash", "rows", "status", "error", "seconds"]
+    cursor.execute(
+        "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT (table_name, file_path, chunk) DO UPDATE SET ({}) = ({}), "
+        "loaded_at = now();".format(
+            manifest_table, ", ".join(columns), ", ".join(["%s"] * len(columns)), ", ".join(columns[3:]),
+            ", ".join("EXCLUDED." + column for column in columns[3:])),
+        [values.get(column) for column in columns])
+
+
+def _load_file(table_name, csv_location, db_engine, manifest_table, chunk_size):
+    """
+    Loads one file for load_files, skipping it or the chunks of it that the manifest says are already loaded
+    :return: Dictionary with the keys: [file, status, rows, seconds]
+    """
+    file_path = os.path.abspath(csv_location)
+    stat = os.stat(file_path)
+    started = time.perf_counter()
+
+    with _checkout(db_engine) as con:
+        done = con.execute(text(
+            "SELECT chunk, start_offset, end_offset, size, mtime, content_hash, rows FROM {} "
+            "WHERE table_name = :table_name AND file_path = :file_path AND status = 'loaded' "
+            "ORDER BY chunk;".format(manifest_table)),
+            table_name=table_name, file_path=file_path).fetchall()
+    row_values = {"table_name": table_name, "file_path": file_path, "size": stat.st_size, "mtime": stat.st_mtime}
+
+    if done and done[0].chunk == -1:
+        whole_file = done[0]
+        # unchanged size and modification time: loaded already, without reading the file
+        if whole_file.size == stat.st_size and whole_file.mtime == stat.st_mtime:
+            logger.info("Skipping " + file_path + ": already loaded into " + table_name)
+            return {"file": file_path, "status": "skipped", "rows": whole_file.rows, "seconds": 0.0}
+        if whole_file.size == stat.st_size and whole_file.content_hash == _file_hash(file_path):
+            # same content, only touched: remember the new modification time
+            with _checkout(db_engine) as con:
+                _record_manifest(con.connection.cursor(), manifest_table, dict(
+                    whole_file._mapping, **row_values, status="loaded"))
+                con.connection.commit()
+            return {"file": file_path, "status": "skipped", "rows": whole_file.rows, "seconds": 0.0}
+        logger.error("File " + file_path + " changed since it was loaded into " + table_name + "! " +
+                     "Remove its rows and its entries in " + manifest_table + " to load it again.")
+        return {"file": file_path, "status": "changed", "rows": 0, "seconds": 0.0}
+
+    # an interrupted run: its chunks can be kept if their bytes are still the same
+    for chunk in done:
+        if chunk.end_offset > stat.st_size or chunk.content_hash != _file_hash(
+                file_path, chunk.start_offset, chunk.end_offset):
+            logger.error("File " + file_path + " changed since part of it was loaded into " + table_name + "! " +
+                         "Remove its rows and its entries in " + manifest_table + " to load it again.")
+            return {"file": file_path, "status": "changed", "rows": 0, "seconds": 0.0}
+    rows = sum(chunk.rows for chunk in done)
+    resume_at = done[-1].end_offset if done else None
+    remaining = stat.st_size - (resume_at or 0)
+    chunks = max(1, -(-remaining // chunk_size)) if chunk_size else 1
+
+    if _compression(file_path) is not None:
+        # compressed bytes can't be split on row boundaries: the file is loaded (and checkpointed) as a whole
+        ranges = [(0, stat.st_size)] if resume_at is None else []
+    else:
+        ranges = _split_csv(file_path, chunks, start=resume_at)
+    for chunk, (start, end) in enumerate(ranges, len(done)):
+        chunk_values = dict(row_values, chunk=chunk, start_offset=start, end_offset=end,
+                            content_hash=_file_hash(file_path, start, end))
+
+        def before_commit(cursor, chunk_rows, seconds):
+            # recorded in the same transaction as the rows, so a chunk is either loaded and recorded or neither
+            _record_manifest(cursor, manifest_table, dict(chunk_values, rows=chunk_rows, seconds=seconds,
+                                                          status="loaded"))
+
+        try:
+            rows += _copy_range(table_name, file_path, start, end, db_engine, before_commit)["rows"]
+        except Exception as e:
+            logger.error("Error importing chunk " + str(chunk) + " of " + file_path + " into the table " + table_name +
+                         " in " + db_engine.url.database + " database!")
+            logger.error(e.args)
+            with _checkout(db_engine) as con:
+                _record_manifest(con.connection.cursor(), manifest_table, dict(chunk_values, status="failed",
+                                                                               error=str(e)))
+                con.connection.commit()
+            return {"file": file_path, "status": "failed", "rows": rows, "seconds": time.perf_counter() - started}
+
+    seconds = time.perf_counter() - started
+    with _checkout(db_engine) as con:
+        _record_manifest(con.connection.cursor(), manifest_table, dict(
+            row_values, chunk=-1, start_offset=0, end_offset=stat.st_size, content_hash=_file_hash(file_path),
+            rows=rows, seconds=seconds, status="loaded"))
+        con.connection.commit()
+    logger.info("Loaded " + file_path + " into " + table_name + ": " + str(rows) + " rows")
+    return {"file": file_path, "status": "loaded", "rows": rows, "seconds": seconds}
+
+
+@_instrumented
+def load_files(table_name, csv_locations, db_engine, manifest_table="public.load_manifest", chunk_size=None):
+    """
+    Populates a table from several csv files, recording every loaded file in a manifest table so that running it again
+    only loads what is new. Files that were loaded and haven't changed are skipped without being read; a file that
+    failed is picked up where it stopped. It can't be called inside a batch().
+    :param table_name: Name of the table that needs to be populated
+    :param csv_locations: List of csv file locations
+    :param db_engine: Specifies the connection to the database
+    :param manifest_table: Name of the manifest table (created if it doesn't exist)
+    :param chunk_size: If given, files are loaded (and checkpointed) in chunks of about this many bytes, so a crash
+    only loses the chunk that was being loaded
+    :return: List with one dictionary per file, with the keys: [file, status, rows, seconds], where status is one of
+    loaded, skipped, failed or changed
+    """
+    if _active_batch(db_engine) is not None:
+        # every chunk is committed with its manifest row on a connection of its own, which would wait for the locks
+        # of the batch's transaction (and a checkpoint that the batch could still roll back isn't one)
+        logger.error("load_files can't run inside a batch, since it commits every file (or chunk) as it is loaded!")
+        exit(1)
+    create_manifest_table(db_engine, manifest_table)
+    return [_load_file(table_name, csv_location, db_engine, manifest_table, chunk_size)
+            for csv_location in csv_locations]
+
+
+def _table_definitions(cursor, table_name):
+    """
+    Reads the definitions of a table's indexes and of the constraints that bulk_load drops while loading. Primary keys
+    and unique constraints that foreign keys of other tables depend on are left out, since they can't be dropped.
+    :param cursor: DBAPI cursor
+    :param table_name: Name of the table
+    :return: Tuple of (indexes, constraints, unlogged, referenced): indexes is a list of (name, definition), constraints
+    a list of (name, type, definition, index definition), unlogged tells if the table is already unlogged and referenced
+    if foreign keys of other tables point to it
+    """
+    cursor.execute(
+        "SELECT i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid) FROM pg_catalog.pg_index i "
+        "WHERE i.indrelid = %s::regclass AND NOT EXISTS ("
+        "SELECT 1 FROM pg_catalog.pg_constraint c WHERE c.conindid = i.indexrelid AND c.conrelid = i.indrelid);",
+        (table_name,))
+    indexes = cursor.fetchall()
+    cursor.execute(
+        "SELECT c.conname, c.contype, pg_get_constraintdef(c.oid), "
+        "CASE WHEN c.contype IN ('p', 'u') THEN pg_get_indexdef(c.conindid) END "
+        "FROM pg_catalog.pg_constraint c WHERE c.conrelid = %s::regclass AND c.contype IN ('p', 'u', 'f', 'x') "
+        "AND NOT (c.contype IN ('p', 'u') AND EXISTS (SELECT 1 FROM pg_catalog.pg_constraint r "
+        "WHERE r.contype = 'f' AND r.confrelid = c.conrelid AND r.conindid = c.conindid)) "
+        "ORDER BY c.contype = 'f';", (table_name,))
+    constraints = cursor.fetchall()
+    cursor.execute(
+        "SELECT relpersistence = 'u', EXISTS (SELECT 1 FROM pg_catalog.pg_constraint r "
+        "WHERE r.contype = 'f' AND r.confrelid = c.oid AND r.conrelid <> c.oid) "
+        "FROM pg_catalog.pg_class c WHERE c.oid = %s::regclass;", (table_name,))
+    unlogged, referenced = cursor.fetchone()
+    return indexes, constraints, unlogged, referenced
+
+
+@_instrumented
+def _build_index(definition, maintenance_work_mem, db_engine):
+    """
+    Creates one index on a connection of its own
+    :param definition: CREATE INDEX statement
+    :param maintenance_work_mem: Memory for the index build, e.g. '1GB'
+    :param db_engine: Specifies the connection to the database
+    :return: None
+    """
+    with _checkout(db_engine) as con:
+        connection = con.connection
+        cursor = connection.cursor()
+        cursor.execute("SET LOCAL maintenance_work_mem TO %s;", (maintenance_work_mem,))
+        # the definition names the table the way it is seen on the search_path
+        cursor.execute('SET LOCAL search_path TO ' + _search_path())
+        logger.debug("Building index: " + definition)
+        cursor.execute(definition)
+        connection.commit()
+
+
+def _add_constraint(cursor, table_name, name, constraint_type, definition):
+    """
+    Adds back a constraint dropped by bulk_load, reusing the index built for it if it is a primary key or unique
+    :param cursor: DBAPI cursor
+    :param table_name: Name of the table
+    :param name: Name of the constraint (and of its index)
+    :param constraint_type: 'p', 'u', 'f' or 'x', as in pg_constraint.contype
+    :param definition: Constraint definition, from pg_get_constraintdef
+    :return: None
+    """
+    if constraint_type == 'p':
+        definition = "PRIMARY KEY USING INDEX " + _quote(name)
+    elif constraint_type == 'u':
+        definition = "UNIQUE USING INDEX " + _quote(name)
+    cursor.execute("ALTER TABLE {} ADD CONSTRAINT {} {};".format(table_name, _quote(name), definition))
+
+
+@_instrumented
+def bulk_load(table_name, csv_location, db_engine, workers=4, maintenance_work_mem="1GB"):
+    """
+    Populates a table with the contents of a csv file the fast way: its indexes and constraints are dropped and it is
+    made UNLOGGED while the rows are copied, then the indexes are rebuilt in parallel over several connections, the
+    constraints added back, the table made LOGGED again and analyzed. If anything fails, the loaded rows are removed
+    and the table gets its original indexes and constraints back. Inside a batch(), the file is copied on the batch's
+    connection instead, with the indexes and constraints in place.
+    :param table_name: Name of the table that needs to be populated
+    :param csv_location: Location of the csv file
+    :param db_engine: Specifies the connection to the database
+    :param workers: Number of indexes built at the same time, each on its own connection
+    :param maintenance_work_mem: Memory for each index build, e.g. '1GB'
+    :return: Number of rows loaded
+    """
+    if _active_batch(db_engine) is not None:
+        # the load commits between its steps and builds the indexes on connections of its own, which would wait for
+        # the locks of the batch's transaction
+        logger.info("Copying " + csv_location + " into " + table_name + " without dropping its indexes, inside the "
+                    "active batch")
+        return populate_table_from_csv(table_name, csv_location, db_engine)
+
+    with _checkout(db_engine) as con:
+        connection = con.connection
+        cursor = connection.cursor()
+
+        try:
+            cursor.execute('SET LOCAL search_path TO ' + _search_path())
+            indexes, constraints, unlogged, referenced = _table_definitions(cursor, table_name)
+            for name, constraint_type, definition, index_definition in reversed(constraints):  # foreign keys first
+                cursor.execute("ALTER TABLE {} DROP CONSTRAINT {};".format(table_name, _quote(name)))
+            for name, definition in indexes:
+                cursor.execute("DROP INDEX {};".format(name))
+            # a table that logged tables' foreign keys point to can't be unlogged
+            set_unlogged = not unlogged and not referenced
+            if set_unlogged:
+                cursor.execute("ALTER TABLE {} SET UNLOGGED;".format(table_name))
+            connection.commit()
+        except Exception as e:
+            connection.rollback()
+            logger.error("Error preparing the table " + table_name + " in " + db_engine.url.database +
+                         " database for bulk loading!")
+            logger.error(e.args)
+            exit(1)
+
+        load_xid = None
+        try:
+            # the copy gets a transaction of its own (the SET UNLOGGED above rewrote every row with the id of its
+            # transaction), so the loaded rows can be told apart by their xmin if they have to be removed again
+            cursor.execute('SET LOCAL search_path TO ' + _search_path())
+            cursor.execute("SELECT txid_current() % 4294967296;")
+            xid = cursor.fetchone()[0]
+            logger.info("Bulk loading " + csv_location + " into " + table_name + "...")
+            with _open_csv(csv_location) as f:
+                f.readline()  # Skip the header row.
+                _copy_from(cursor, f, table_name)
+            rows = cursor.rowcount
+            connection.commit()
+            load_xid = xid
+
+            index_definitions = [definition for name, definition in indexes] + \
+                                [index_definition for name, constraint_type, definition, index_definition in constraints
+                                 if index_definition is not None]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_in_target_schema(_build_index), definition, maintenance_work_mem,
+                                           db_engine) for definition in index_definitions]
+                for future in futures:
+                    future.result()
+            cursor.execute('SET LOCAL search_path TO ' + _search_path())
+            for name, constraint_type, definition, index_definition in constraints:
+                _add_constraint(cursor, table_name, name, constraint_type, definition)
+            if set_unlogged:
+                cursor.execute("ALTER TABLE {} SET LOGGED;".format(table_name))
+            cursor.execute("ANALYZE {};".format(table_name))
+            connection.commit()
+        except Exception as e:
+            logger.error("Error bulk loading the table " + table_name + " in " + db_engine.url.database +
+                         " database from " + csv_location + "! Removing the loaded rows and restoring its definition...")
+            logger.error(e.args)
+            connection.rollback()
+            cursor.execute('SET LOCAL search_path TO ' + _search_path())
+            if load_xid is not None:
+                cursor.execute("DELETE FROM {} WHERE xmin = %s::text::xid;".format(table_name), (str(load_xid),))
+            cursor.execute(
+                "SELECT c.relname FROM pg_catalog.pg_index i JOIN pg_catalog.pg_class c ON c.oid = i.indexrelid "
+                "WHERE i.indrelid = %s::regclass;", (table_name,))
+            existing_indexes = {row[0] for row in cursor.fetchall()}
+            cursor.execute("SELECT conname FROM pg_catalog.pg_constraint WHERE conrelid = %s::regclass;",
+                           (table_name,))
+            existing_constraints = {row[0] for row in cursor.fetchall()}
+            for name, definition in indexes:
+                if name.split('.')[-1].strip('"') not in existing_indexes:
+                    cursor.execute(definition)
+            for name, constraint_type, definition, index_definition in constraints:
+                if name not in existing_constraints:
+                    if index_definition is not None and name not in existing_indexes:
+                        cursor.execute(index_definition)
+                    _add_constraint(cursor, table_name, name, constraint_type, definition)
+            if set_unlogged:
+                cursor.execute("ALTER TABLE {} SET LOGGED;".format(table_name))
+            connection.commit()
+            exit(1)
+
+    logger.info("Bulk loaded " + str(rows) + " rows into " + table_name)
+    return rows
+
+
+# partition name suffixes and the start of the next range, per interval of create_range_partitions
+_partition_intervals = {
+    "day": ("%Y%m%d", lambda day: day + datetime.timedelta(days=1)),
+    "month": ("%Y%m", lambda day: (day.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)),
+    "year": ("%Y", lambda day: day.replace(year=day.year + 1)),
+}
+
+
+def _interval_start(day, interval):
+    """
+    Returns the first day of the interval that contains day
+    :param day: datetime.date
+    :param interval: 'day', 'month' or 'year'
+    :return: datetime.date
+    """
+    if interval == "month":
+        return day.replace(day=1)
+    if interval == "year":
+        return day.replace(month=1, day=1)
+    return day
+
+
+def _partition_name(table_name, suffix):
+    """
+    Returns the name of a partition of table_name, in the same schema
+    :param table_name: Name of the partitioned table
+    :param suffix: Suffix identifying the partition
+    :return: Partition name
+    """
+    return table_name + "_" + re.sub(r"\W", "_", str(suffix))
+
+
+def _create_partition(cursor, table_name, partition_name, bound):
+    """
+    Creates a partition if it doesn't exist
+    :param cursor: DBAPI cursor
+    :param table_name: Name of the partitioned table
+    :param partition_name: Name of the partition
+    :param bound: Partition bound, e.g. "FROM ('2020-01-01') TO ('2020-02-01')"
+    :return: None
+    """
+    logger.info("Creating partition " + partition_name + " of " + table_name)
+    cursor.execute("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES {};".format(
+        partition_name, table_name, bound))
+
+
+def _partitions(cursor, table_name):
+    """
+    Reads how a table is partitioned
+    :param cursor: DBAPI cursor
+    :param table_name: Name of the partitioned table
+    :return: Tuple of (strategy, key column, partitions), where strategy is 'r' (range) or 'l' (list), and partitions
+    is a list of (schema-qualified partition name, bound expression)
+    """
+    cursor.execute(
+        "SELECT p.partstrat, a.attname FROM pg_catalog.pg_partitioned_table p "
+        "JOIN pg_catalog.pg_attribute a ON a.attrelid = p.partrelid AND a.attnum = p.partattrs[0] "
+        "WHERE p.partrelid = %s::regclass;", (table_name,))
+    row = cursor.fetchone()
+    if row is None:
+        raise ValueError("Table {} is not partitioned on a column".format(table_name))
+    cursor.execute(
+        "SELECT format('%%I.%%I', n.nspname, c.relname), pg_get_expr(c.relpartbound, c.oid) "
+        "FROM pg_catalog.pg_inherits i JOIN pg_catalog.pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace WHERE i.inhparent = %s::regclass;", (table_name,))
+    return row[0], row[1], cursor.fetchall()
+
+
+def _range_bounds(bound):
+    """
+    Parses the bound of a range partition on a date column
+    :param bound: Bound expression, e.g. "FOR VALUES FROM ('2020-01-01') TO ('2020-02-01')"
+    :return: (low, high) as datetime.date, None for MINVALUE/MAXVALUE, or None for a DEFAULT partition
+    """
+    match = re.match(r"FOR VALUES FROM \((.*)\) TO \((.*)\)", bound)
+    if match is None:
+        return None
+    return tuple(None if value.strip() in ("MINVALUE", "MAXVALUE") else
+                 datetime.date.fromisoformat(value.strip().strip("'")[:10]) for value in match.groups())
+
+
+def _list_values(bound):
+    """
+    Parses the bound of a list partition
+    :param bound: Bound expression, e.g. "FOR VALUES IN (1, 2)"
+    :return: List of the values as strings, or None for a DEFAULT partition
+    """
+    match = re.match(r"FOR VALUES IN \((.*)\)", bound)
+    if match is None:
+        return None
+    return [value.strip().strip("'") for value in match.group(1).split(",")]
+
+
+@_instrumented
+def create_range_partitions(db_engine, table_name, start, end, interval="month"):
+    """
+    Creates the missing partitions of a table partitioned by range on a date column, so that every day from start to
+    end is covered. Partitions are named after their first day, e.g. events_202001 for January 2020.
+    :param db_engine: Specifies the connection to the database
+    :param table_name: Name of the partitioned table
+    :param start: datetime.date; first day to cover
+    :param end: datetime.date; last day to cover
+    :param interval: Size of each partition: 'day', 'month' or 'year'
+    :return: None
+    """
+    suffix_format, next_start = _partition_intervals[interval]
+    with _connect(db_engine) as con:
+        connection = con.connection
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SET LOCAL search_path TO ' + _search_path())
+            low = _interval_start(start, interval)
+            while low <= end:
+                high = next_start(low)
+                partition_name = _partition_name(table_name, low.strftime(suffix_format))
+                _create_partition(cursor, table_name, partition_name, "FROM ('{}') TO ('{}')".format(low, high))
+                _update_catalog(db_engine, partition_name, True)
+                low = high
+            if _active_batch(db_engine) is None:  # a batch commits on its own
+                connection.commit()
+        except Exception as e:
+            logger.error("Error creating the partitions of " + table_name + " in " + db_engine.url.database +
+                         " database!")
+            logger.error(e.args)
+            exit(1)
+
+
+@_instrumented
+def create_list_partitions(db_engine, table_name, values):
+    """
+    Creates the missing partitions of a table partitioned by list, one per value (e.g. one per herd id). Partitions
+    are named after their value, e.g. events_42.
+    :param db_engine: Specifies the connection to the database
+    :param table_name: Name of the partitioned table
+    :param values: Iterable of partition key values
+    :return: None
+    """
+    with _connect(db_engine) as con:
+        connection = con.connection
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SET LOCAL search_path TO ' + _search_path())
+            for value in values:
+                partition_name = _partition_name(table_name, value)
+                _create_partition(cursor, table_name, partition_name,
+                                  "IN ('{}')".format(str(value).replace("'", "''")))
+                _update_catalog(db_engine, partition_name, True)
+            if _active_batch(db_engine) is None:  # a batch commits on its own
+                connection.commit()
+        except Exception as e:
+            logger.error("Error creating the partitions of " + table_name + " in " + db_engine.url.database +
+                         " database!")
+            logger.error(e.args)
+            exit(1)
+
+
+@_instrumented
+def drop_partitions_before(db_engine, table_name, before):
+    """
+    Detaches and drops the partitions of a table partitioned by range on a date column that only hold days before
+    before (for data retention)
+    :param db_engine: Specifies the connection to the database
+    :param table_name: Name of the partitioned table
+    :param before: datetime.date; partitions ending on or before this day are dropped
+    :return: List of the names of the dropped partitions
+    """
+    dropped = []
+    with _connect(db_engine) as con:
+        connection = con.connection
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SET LOCAL search_path TO ' + _search_path())
+            strategy, key_column, partitions = _partitions(cursor, table_name)
+            for partition_name, bound in partitions:
+                bounds = _range_bounds(bound) if strategy == 'r' else None
+                if bounds is not None and bounds[1] is not None and bounds[1] <= before:
+                    logger.info("Dropping partition " + partition_name + " of " + table_name)
+                    cursor.execute("ALTER TABLE {} DETACH PARTITION {};".format(table_name, partition_name))
+                    cursor.execute("DROP TABLE {};".format(partition_name))
+                    _update_catalog(db_engine, partition_name, False)
+                    dropped.append(partition_name)
+            if _active_batch(db_engine) is None:  # a batch commits on its own
+                connection.commit()
+        except Exception as e:
+            logger.error("Error dropping the partitions of " + table_name + " in " + db_engine.url.database +
+                         " database!")
+            logger.error(e.args)
+            exit(1)
+    return dropped
+
+
+@_instrumented
+def populate_partitioned_table_from_csv(table_name, csv_location, db_engine, parse_key=None, interval="month"):
+    """
+    Populates a partitioned table with the contents of a csv file. The file's partition key column is read first, to
+    create the partitions missing for its rows (see create_range_partitions and create_list_partitions); then the
+    whole file is copied into the partitioned table, which routes every row to its partition.
+    :param table_name: Name of the partitioned table
+    :param csv_location: Location of the csv file
+    :param db_engine: Specifies the connection to the database
+    :param parse_key: For range partitions, function turning the key column's text into a datetime.date (defaults to
+    ISO dates, e.g. '2020-01-31'); use lambda text: datetime.datetime.strptime(text, '%m/%d/%y').date() for DairyComp
+    dates
+    :param interval: Size of the range partitions created for new dates: 'day', 'month' or 'year'
+    :return: Dictionary with the number of rows copied into each partition, by schema-qualified partition name
+    """
+    parse_key = parse_key or datetime.date.fromisoformat
+    suffix_format, next_start = _partition_intervals[interval]
+    with _connect(db_engine) as con:
+        connection = con.connection
+        cursor = connection.cursor()
+
+        try:
+            cursor.execute('SET LOCAL search_path TO ' + _search_path())
+            strategy, key_column, partitions = _partitions(cursor, table_name)
+            key_position = _table_columns(cursor, table_name).index(key_column)
+
+            # only the key column is needed to know which partitions the rows go to; it is tokenized the way COPY's
+            # text format reads the file, with backslash-escaped commas and no quoting
+            keys = collections.Counter()
+            with _open_csv(csv_location, binary=False) as f:
+                reader = csv.reader(f, delimiter=',', quoting=csv.QUOTE_NONE, escapechar='\\')
+                next(reader)  # Skip the header row.
+                for row in reader:
+                    keys[row[key_position].strip() if len(row) > key_position else ""] += 1
+            days = {key: parse_key(key) for key in keys if key} if strategy == 'r' else {}
+
+            def route(partitions):
+                # key -> partition name, for the keys the existing partitions take
+                default_partition, ranges, values = None, [], {}
+                for partition_name, bound in partitions:
+                    if bound == "DEFAULT":
+                        default_partition = partition_name
+                    elif strategy == 'r':
+                        low, high = _range_bounds(bound)
+                        ranges.append((low or datetime.date.min, high or datetime.date.max, partition_name))
+                    else:
+                        values.update((value, partition_name) for value in _list_values(bound))
+                ranges.sort()
+                routes = {}
+                for key in keys:
+                    if not key:
+                        routes[key] = default_partition
+                    elif strategy == 'r':
+                        day = days[key]
+                        index = bisect.bisect_right(ranges, (day, datetime.date.max)) - 1
+                        if index >= 0 and ranges[index][0] <= day < ranges[index][1]:
+                            routes[key] = ranges[index][2]
+                    else:
+                        routes[key] = values.get(key)
+                return routes
+
+            routes = route(partitions)
+            if "" in keys and routes[""] is None:
+                raise ValueError("No default partition of {} for the rows without a {}".format(table_name, key_column))
+            for key in keys:
+                if routes.get(key) is not None:
+                    continue
+                if strategy == 'r':
+                    low = _interval_start(days[key], interval)
+                    partition_name = _partition_name(table_name, low.strftime(suffix_format))
+                    bound = "FROM ('{}') TO ('{}')".format(low, next_start(low))
+                else:
+                    partition_name = _partition_name(table_name, key)
+                    bound = "IN ('{}')".format(key.replace("'", "''"))
+                _create_partition(cursor, table_name, partition_name, bound)
+                _update_catalog(db_engine, partition_name, True)
+                routes = route(_partitions(cursor, table_name)[2])
+
+            with _open_csv(csv_location) as f:
+                f.readline()  # Skip the header row.
+                _copy_from(cursor, f, table_name)
+            rows = {}
+            for key, count in keys.items():
+                rows[routes[key]] = rows.get(routes[key], 0) + count
+            if _active_batch(db_engine) is None:  # a batch commits on its own
+                connection.commit()
+
+        except Exception as e:
+            logger.error(
+                "Error importing the table " + table_name + " in " + db_engine.url.database +
+                " database from " + csv_location + "!")
+            logger.error(e.args)
+            exit(1)
+
+    return rows
+
+
+# PostgreSQL's epoch for dates and timestamps in the binary format
+_pg_epoch_date = datetime.date(2000, 1, 1)
+_pg_epoch_timestamp = datetime.datetime(2000, 1, 1)
+_pg_null = struct.pack('!i', -1)
+
+
+def _encode_text(value):
+    data = str(value).encode()
+    return struct.pack('!i', len(data)) + data
+
+
+def _encode_date(value):
+    return struct.pack('!ii', 4, (value - _pg_epoch_date).days)
+
+
+def _encode_timestamp(value):
+    delta = value - _pg_epoch_timestamp
+    return struct.pack('!iq', 8, (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+# binary COPY encoders, by column type; each returns the field length followed by the value
+_binary_encoders = {
+    'smallint': functools.partial(struct.Struct('!ih').pack, 2),
+    'integer': functools.partial(struct.Struct('!ii').pack, 4),
+    'bigint': functools.partial(struct.Struct('!iq').pack, 8),
+    'real': functools.partial(struct.Struct('!if').pack, 4),
+    'double precision': functools.partial(struct.Struct('!id').pack, 8),
+    'boolean': functools.partial(struct.Struct('!i?').pack, 1),
+    'date': _encode_date,
+    'timestamp without time zone': _encode_timestamp,
+    'text': _encode_text,
+    'character varying': _encode_text,
+    'character': _encode_text,
+}
+
+
+class _BinaryCopyStream:
+    """
+    Read-only file-like object that encodes rows into PostgreSQL's binary COPY format on demand
+    """
+
+    def __init__(self, rows, encoders, rows_per_block=1000):
+        self.rows = iter(rows)
+        self.encoders = encoders
+        self.field_count = struct.pack('!h', len(encoders))
+        self.rows_per_block = rows_per_block
+        # signature, flags and header extension length
+        self.buffer = bytearray(b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0))
+        self.position = 0
+        self.finished = False
+        self.count = 0
+
+    def _encode(self):
+        """
+        Encodes the next block of rows into the buffer (or the trailer, once the rows are exhausted)
+        :return: None
+        """
+        buffer = self.buffer
+        encoders = self.encoders
+        field_count = self.field_count
+        null = _pg_null
+        join = b''.join
+        count = 0
+        for row in itertools.islice(self.rows, self.rows_per_block):
+            buffer += field_count + join([null if value is None else encode(value)
+                                          for encode, value in zip(encoders, row)])
+            count += 1
+        self.count += count
+        if count < self.rows_per_block:
+            buffer += struct.pack('!h', -1)
+            self.finished = True
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.buffer) - self.position < size):
+            if self.position:  # reuse the buffer instead of growing it
+                del self.buffer[:self.position]
+                self.position = 0
+            self._encode()
+        end = len(self.buffer) if size < 0 else self.position + size
+        data = bytes(self.buffer[self.position:end])
+        self.position += len(data)
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size if size >= 0 else 8192)
+
+
+@_instrumented
+def copy_rows(db_engine, table_name, columns, rows):
+    """
+    Populates a table with rows built in Python, sending them in PostgreSQL's binary COPY format so no csv file is
+    written and the server doesn't have to parse text. Supported column types are smallint, integer, bigint, real,
+    double precision, boolean, date, timestamp (without time zone), text, varchar and char.
+    :param db_engine: Specifies the connection to the database
+    :param table_name: Name of the table that needs to be populated
+    :param columns: List of the column names the values of each row go to
+    :param rows: Iterable of rows (sequences of values in the order of columns; None for NULL)
+    :return: Number of rows copied
+    """
+    with _connect(db_engine) as con:
+        connection = con.connection
+        cursor = connection.cursor()
+
+        try:
+            cursor.execute('SET LOCAL search_path TO ' + _search_path())
+            cursor.execute(
+                "SELECT attname, format_type(atttypid, NULL) FROM pg_catalog.pg_attribute "
+                "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped;", (table_name,))
+            column_types = dict(cursor.fetchall())
+            encoders = []
+            for column in columns:
+                if column_types.get(column) not in _binary_encoders:
+                    raise ValueError("Column {} of {} has unsupported type {}".format(
+                        column, table_name, column_types.get(column)))
+                encoders.append(_binary_encoders[column_types[column]])
+
+            stream = _BinaryCopyStream(rows, encoders)
+            cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT binary);".format(
+                table_name, ", ".join(_quote(column) for column in columns)), stream)
+            if _active_batch(db_engine) is None:  # a batch commits on its own
+                connection.commit()
+
+        except Exception as e:
+            logger.error("Error copying rows into the table " + table_name + " in " + db_engine.url.database +
+                         " database!")
+            logger.error(e.args)
+            exit(1)
+
+    return stream.count
+
+
+def _shard_name(csv_location, shard):
+    """
+    Returns the name of one shard of an export, e.g. events.part002.csv.gz for events.csv.gz
+    :param csv_location: Location of the whole export
+    :param shard: Index of the shard
+    :return: Location of the shard
+    """
+    directory, filename = os.path.split(csv_location)
+    name, dot, extensions = filename.partition('.')
+    return os.path.join(directory, "{}.part{:03d}{}{}".format(name, shard, dot, extensions))
+
+
+@_instrumented
+def _export_range(table_name, condition, csv_location, header, snapshot, db_engine):
+    """
+    Copies the rows of a table that match condition into a file, on a connection of its own
+    :param table_name: Name of the table to be exported
+    :param condition: SQL condition selecting the rows to export
+    :param csv_location: Location of the file to write (compressed if it ends with .gz, .bz2 or .zst)
+    :param header: Header row to write first, or None
+    :param snapshot: Exported snapshot id, so every range sees the same data
+    :param db_engine: Specifies the connection to the database
+    :return: Number of rows written
+    """
+    with _checkout(db_engine) as con:
+        # importing a snapshot needs REPEATABLE READ from the first statement (psycopg2 opens the transaction itself);
+        # the pool resets the isolation level when the connection is returned
+        con.execution_options(isolation_level="REPEATABLE READ")
+        connection = con.connection
+        cursor = connection.cursor()
+        cursor.execute("SET TRANSACTION SNAPSHOT %s;", (snapshot,))
+        cursor.execute('SET LOCAL search_path TO ' + _search_path())
+        rows = _copy_to_file(cursor, table_name, condition, csv_location, header)
+        connection.rollback()
+    return rows
+
+
+def _copy_to_file(cursor, table_name, condition, csv_location, header):
+    """
+    Copies the rows of a table that match condition into a file, with the cursor's connection
+    :param cursor: DBAPI cursor
+    :param table_name: Name of the table to be exported
+    :param condition: SQL condition selecting the rows to export
+    :param csv_location: Location of the file to write (compressed if it ends with .gz, .bz2 or .zst)
+    :param header: Header row to write first, or None
+    :return: Number of rows written
+    """
+    compression = _compression(csv_location, check_content=False)
+    with (_open_compressed(csv_location, compression, 'wb') if compression is not None
+          else open(csv_location, 'wb')) as f:
+        if header is not None:
+            f.write(header)
+        cursor.copy_expert("COPY (SELECT * FROM {} WHERE {}) TO STDOUT WITH (DELIMITER ',', NULL '');".format(
+            table_name, condition), f)
+    return cursor.rowcount
+
+
+@_instrumented
+def export_table_to_csv(table_name, csv_location, db_engine, workers=1, key_column=None, sharded=False):
+    """
+    Writes the contents of a table to a csv file (with a header row, in the format populate_table_from_csv reads).
+    With several workers, the table is split into ranges that are exported concurrently over separate connections,
+    all reading the same snapshot of the table. Inside a batch(), the table is exported in one range on the batch's
+    connection, so the batch's own changes are included.
+    :param table_name: Name of the table to be exported
+    :param csv_location: Location of the csv file; it is compressed on the fly if the name ends with .gz, .bz2 or
+    .zst
+    :param db_engine: Specifies the connection to the database
+    :param workers: Number of concurrent connections
+    :param key_column: Optional integer column to split the table on; by default it is split on physical location
+    (ctid)
+    :param sharded: If True, every range is written to its own file (events.part000.csv, events.part001.csv, ...)
+    instead of being concatenated into csv_location
+    :return: Dictionary with the keys: [files, rows]
+    """
+    if _active_batch(db_engine) is not None:
+        # other connections can't see the batch's uncommitted rows, nor wait for its locks: export on its connection
+        files = [_shard_name(csv_location, 0) if sharded else csv_location]
+        logger.info("Exporting " + table_name + " to " + files[0] + " in one range, inside the active batch")
+        with _connect(db_engine) as con:
+            cursor = con.connection.cursor()
+            try:
+                cursor.execute('SET LOCAL search_path TO ' + _search_path())
+                columns = _table_columns(cursor, table_name)
+                rows = _copy_to_file(cursor, table_name, "true", files[0], (",".join(columns) + "\n").encode())
+            except Exception as e:
+                logger.error("Error exporting the table " + table_name + " in " + db_engine.url.database +
+                             " database to " + csv_location + "!")
+                logger.error(e.args)
+                exit(1)
+        return {"files": files, "rows": rows}
+
+    with _checkout(db_engine) as con:
+        # the snapshot the workers import has to be taken in a REPEATABLE READ transaction
+        con.execution_options(isolation_level="REPEATABLE READ")
+        connection = con.connection
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SET LOCAL search_path TO ' + _search_path())
+            cursor.execute("SELECT pg_export_snapshot();")
+            snapshot = cursor.fetchone()[0]
+            columns = _table_columns(cursor, table_name)
+
+            if workers <= 1:
+                conditions = ["true"]
+            elif key_column is not None:
+                cursor.execute("SELECT min({0}), max({0}) FROM {1};".format(_quote(key_column), table_name))
+                low, high = cursor.fetchone()
+                low, high = (low or 0), (high or 0) + 1
+                bounds = [low + (high - low) * i // workers for i in range(workers + 1)]
+                conditions = ["{0} >= {1} AND {0} < {2}".format(_quote(key_column), bounds[i], bounds[i + 1])
+                              for i in range(workers)]
+                conditions[0] += " OR {} IS NULL".format(_quote(key_column))
+            else:
+                cursor.execute("SELECT pg_relation_size(%s::regclass) / current_setting('block_size')::bigint;",
+                               (table_name,))
+                blocks = cursor.fetchone()[0] + 1
+                bounds = [blocks * i // workers for i in range(workers + 1)]
+                conditions = ["ctid >= '({},0)'::tid AND ctid < '({},0)'::tid".format(bounds[i], bounds[i + 1])
+                              for i in range(workers)]
+                conditions[-1] = "ctid >= '({},0)'::tid".format(bounds[-2])
+
+            header = (",".join(columns) + "\n").encode()
+            if len(conditions) == 1 and not sharded:
+                files = [csv_location]
+            else:
+                files = [_shard_name(csv_location, shard) for shard in range(len(conditions))]
+            logger.info("Exporting " + table_name + " to " + csv_location + " in " + str(len(files)) + " ranges...")
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+                futures = [executor.submit(_in_target_schema(_export_range), table_name, condition, shard_file,
+                                           header if sharded or shard == 0 else None, snapshot, db_engine)
+                           for shard, (condition, shard_file) in enumerate(zip(conditions, files))]
+                rows = sum(future.result() for future in futures)
+            connection.rollback()
+
+            if not sharded and files != [csv_location]:
+                # gzip members, bz2 streams and zstd frames can be concatenated as they are
+                with open(csv_location, 'wb') as out:
+                    for shard_file in files:
+                        with open(shard_file, 'rb') as f:
+                            shutil.copyfileobj(f, out, 1 << 20)
+                        os.remove(shard_file)
+                files = [csv_location]
+
+        except Exception as e:
+            logger.error("Error exporting the table " + table_name + " in " + db_engine.url.database +
+                         " database to " + csv_location + "!")
+            logger.error(e.args)
+            exit(1)
+
+    return {"files": files, "rows": rows}
+
+
+# suffixes for the names of server-side cursors
+_cursor_ids = itertools.count()
+
+
+@_instrumented
+def stream_query(db_engine, sql, params=None, batch_size=10000, columnar=False):
+    """
+    Runs a query with a server-side cursor and yields its result in batches, so only one batch is in memory at a time
+    however large the result is
+    :param db_engine: Specifies the connection to the database
+    :param sql: String; SQL query, with psycopg2-style placeholders (%s or %(name)s)
+    :param params: Optional sequence or mapping of query parameters
+    :param batch_size: Number of rows fetched from the server per batch
+    :param columnar: If True, yields each batch as a dictionary of column name -> NumPy array instead of a list of
+    row tuples (requires numpy)
+    :return: Generator of batches
+    """
+    if columnar:
+        import numpy
+
+    with _connect(db_engine) as con:
+        connection = con.connection
+        # a named cursor lives on the server: rows are only sent when they are fetched
+        cursor = connection.cursor(name="dbu_stream_{}".format(next(_cursor_ids)))
+        cursor.itersize = batch_size
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                if columnar:
+                    yield {column[0]: numpy.array(values)
+                           for column, values in zip(cursor.description, zip(*rows))}
+                else:
+                    yield rows
+        except Exception as e:
+            logger.error("Error streaming query {}".format(sql))
+            logger.error(e.args)
+            exit(1)
+        finally:
+            cursor.close()
+            if _active_batch(db_engine) is None:
+                connection.rollback()  # ends the read-only transaction the named cursor needed
+
+
+# statements that may create, drop or rename tables, which makes a cached catalog out of date
+_ddl_pattern = re.compile(r"\b(CREATE|DROP|ALTER)\b", re.IGNORECASE)
+# CREATE or DROP of relations the catalog cache can record in place (names without quotes)
+_relation_ddl_pattern = re.compile(
+    r"^\s*(CREATE|DROP)\s+(?:UNLOGGED\s+)?(?:TABLE|VIEW|SEQUENCE|MATERIALIZED\s+VIEW|FOREIGN\s+TABLE)\s+"
+    r"(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([\w.]+(?:\s*,\s*[\w.]+)*)(?=[\s(;]|$)", re.IGNORECASE)
+
+
+def _record_ddl(statement, db_engine):
+    """
+    Updates the cached catalog of db_engine (if there is one) for the DDL in a statement run by execute_statement.
+    Statements it can't follow (ALTER, DROP ... CASCADE, quoted names, ...) make the whole catalog reload instead.
+    :param statement: String; SQL statement, possibly several separated by semicolons
+    :param db_engine: Specifies the connection to the database
+    :return: None
+    """
+    for part in statement.split(';'):
+        if not _ddl_pattern.search(part):
+            continue
+        match = _relation_ddl_pattern.match(part)
+        if match is None or re.search(r"\bCASCADE\b", part, re.IGNORECASE):
+            refresh_catalog(db_engine)
+            return
+        exists = match.group(1).upper() == "CREATE"
+        partitioned = exists and re.search(r"\bPARTITION\s+BY\b", part, re.IGNORECASE) is not None
+        for table_name in match.group(2).split(','):
+            _update_catalog(db_engine, table_name.strip().lower(), exists, partitioned)
+
+
+def _values_clause(statement):
+    """
+    Finds the VALUES (...) row of an INSERT statement, so a list of rows can be sent as one multi-row VALUES
+    :param statement: SQL statement with %(name)s placeholders
+    :return: Tuple of (text before the row, the row, text after the row), or None if it isn't an INSERT ... VALUES
+    """
+    match = re.match(r"\s*INSERT\b.*?\bVALUES\s*\(", statement, re.IGNORECASE | re.DOTALL)
+    if match is None:
+        return None
+    start = match.end() - 1
+    depth = 0
+    quoted = False
+    for position in range(start, len(statement)):
+        character = statement[position]
+        if character == "'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif character == "(":
+            depth += 1
+        elif character == ")":
+            depth -= 1
+            if depth == 0:
+                rest = statement[position + 1:]
+                if rest.lstrip().startswith(","):  # already lists several rows
+                    return None
+                return statement[:start], statement[start:position + 1], rest
+    return None
+
+
+@_instrumented
+def execute_statement(statement, db_engine, params=None, page_size=1000):
+    """
+    Executes a SQL statement in the database
+    :param statement: String; SQL statement, with :name placeholders if params are given
+    :param db_engine: Specifies the connection to the database
+    :param params: Optional values of the placeholders: a dictionary, or a list of dictionaries to execute the
+    statement once per dictionary. Lists are sent in pages of page_size rows in a single transaction, as one
+    multi-row VALUES per page for INSERT ... VALUES statements.
+    :param page_size: Number of rows sent per round-trip when params is a list
+    :return: None
+    """
+    if params is None:
+        with _connect(db_engine, pipelined=True) as con:
+            try:
+                con.execute(text(statement))
+                _record_ddl(statement, db_engine)
+            except Exception as e:
+                logger.error("Error executing statement {}".format(statement))
+                logger.error(e.args)
+                exit(1)
+        return
+
+    with _connect(db_engine) as con:
+        connection = con.connection
+        cursor = connection.cursor()
+        try:
+            # compile the :name placeholders into the driver's %(name)s ones
+            compiled = str(text(statement).compile(dialect=db_engine.dialect))
+            if isinstance(params, collections.abc.Mapping):
+                cursor.execute(compiled, params)
+            else:
+                values = _values_clause(compiled)
+                if values is not None:
+                    prefix, row, suffix = values
+                    psycopg2.extras.execute_values(cursor, prefix + "%s" + suffix, params, template=row,
+                                                   page_size=page_size)
+                else:
+                    psycopg2.extras.execute_batch(cursor, compiled, params, page_size=page_size)
+            if _active_batch(db_engine) is None:  # a batch commits on its own
+                connection.commit()
+            _record_ddl(statement, db_engine)
+        except Exception as e:
+            logger.error("Error executing statement {}".format(statement))
+            logger.error(e.args)
+            exit(1)
+
+
+@_instrumented
+def drop_table(table_name, db_engine):
+    """
+    Drops a table from the database
+    :param table_name: Name of the table that needs to be dropped
+    :param db_engine: Specifies the connection to the database
+    :return: None
+    """
+    current = _active_batch(db_engine)
+    # in a pipelined batch the statement is queued as it is, since asking has_table first would flush the queue
+    if (current is not None and current.pipeline) or has_table(table_name, db_engine):
+        logger.debug("Deleting old (pre-existing) table: " + table_name + "...")
+        statement = str("DROP TABLE IF EXISTS {};")
+
+        with _connect(db_engine, pipelined=True) as con:
+            try:
+                con.execute(statement.format(table_name))
+                _update_catalog(db_engine, table_name, False)
+            except Exception as e:
+                logger.error("Error deleting table " + table_name + " from database!")
+                logger.error(e.args)
+                exit(1)
+
+
+@_instrumented
+def has_table(table_name, db_engine):
+    """
+    Checks if a table with table_name is in the database. Answered from memory if cache_catalog was called on db_engine.
+    :param table_name: Name of the table that needs to be checked
+    :param db_engine: Specifies the connection to the database
+    :return: True if table with table_name is in the database, False otherwise
+    """
+    catalog = _cached_catalog(db_engine)
+    if catalog is not None:
+        return catalog.has_table(table_name)
+
+    with _connect(db_engine) as con:
+        if '.' in table_name:  # received schema.table_name
+            return db_engine.dialect.has_table(con, table_name.split('.')[1], schema=table_name.split('.')[0])
+        else:  # received plain table_name
+            return db_engine.dialect.has_table(con, table_name)
+
+
+@_instrumented
+def tables_exist(table_names, db_engine):
+    """
+    Checks which of the given tables are in the database, with at most one query
+    :param table_names: List of table names (table_name or schema.table_name)
+    :param db_engine: Specifies the connection to the database
+    :return: List of booleans, True for every table that is in the database
+    """
+    catalog = _cached_catalog(db_engine)
+    if catalog is None:
+        catalog = _load_catalog(db_engine)
+    return [catalog.has_table(table_name) for table_name in table_names]
+
+
+class _Catalog:
+    """
+    Snapshot of the tables, views and sequences in the database, taken from pg_catalog in one query
+    """
+
+    # tables, partitioned tables, views, materialized views, foreign tables and sequences, followed by the schemas in
+    # the search_path in order (with a NULL relation name)
+    query = """
+        SELECT n.nspname, c.relname, c.relkind = 'p'
+        FROM pg_catalog.pg_class c
+        JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind IN ('r', 'p', 'v', 'm', 'f', 'S')
+        UNION ALL
+        SELECT unnest(pg_catalog.current_schemas(false)), NULL, NULL;
+    """
+
+    def __init__(self, rows, ttl):
+        self.relations = set()
+        self.partitioned = set()
+        self.search_path = []
+        for schema_name, relation_name, partitioned in rows:
+            if relation_name is None:
+                self.search_path.append(schema_name)
+                continue
+            self.relations.add((schema_name, relation_name))
+            if partitioned:
+                self.partitioned.add((schema_name, relation_name))
+        self.visible = {relation_name for schema_name, relation_name in self.relations
+                        if schema_name in self.search_path}
+        self.ttl = ttl
+        self.loaded_at = time.monotonic()
+        self.stale = False
+
+    def expired(self):
+        return self.stale or (self.ttl is not None and time.monotonic() - self.loaded_at > self.ttl)
+
+    def resolve(self, table_name):
+        """
+        Returns the (schema, relation) a name refers to, resolving plain names against the search_path the way
+        PostgreSQL does: the first schema holding a relation of that name, or None if there is none
+        """
+        if '.' in table_name:  # received schema.table_name
+            return tuple(table_name.split('.', 1))
+        for schema_name in self.search_path:
+            if (schema_name, table_name) in self.relations:
+                return schema_name, table_name
+        return None
+
+    def has_table(self, table_name):
+        if '.' in table_name:  # received schema.table_name
+            return tuple(table_name.split('.', 1)) in self.relations
+        else:  # received plain table_name
+            return table_name in self.visible
+
+    def update(self, table_name, exists, partitioned=False):
+        """
+        Records a relation that was created or dropped
+        :return: False if the change can't be worked out, so the snapshot has to be reloaded
+        """
+        if exists:
+            if '.' in table_name:
+                relation = tuple(table_name.split('.', 1))
+            elif self.search_path:  # plain names are created in the first schema of the search_path
+                relation = (self.search_path[0], table_name)
+            else:
+                return False
+            self.relations.add(relation)
+            if partitioned:
+                self.partitioned.add(relation)
+        else:
+            relation = self.resolve(table_name)
+            if relation is None:
+                return True
+            if relation in self.partitioned:  # its partitions are gone too
+                return False
+            self.relations.discard(relation)
+        # a relation of the same name further down the search_path may be hidden, or visible again
+        if any((schema_name, relation[1]) in self.relations for schema_name in self.search_path):
+            self.visible.add(relation[1])
+        else:
+            self.visible.discard(relation[1])
+        return True
+
+
+# catalog snapshots of the engines that cache_catalog was called on, keyed by engine
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def _load_catalog(db_engine, ttl=None):
+    """
+    Reads a catalog snapshot from the database
+    :param db_engine: Specifies the connection to the database
+    :param ttl: Number of seconds the snapshot stays valid, or None for no limit
+    :return: A _Catalog instance
+    """
+    with _connect(db_engine) as con:
+        try:
+            return _Catalog(con.execute(text(_Catalog.query)).fetchall(), ttl)
+        except Exception as e:
+            logger.error("Error reading the catalog of " + db_engine.url.database + " database!")
+            logger.error(e.args)
+            exit(1)
+
+
+def _cached_catalog(db_engine):
+    """
+    Returns the cached catalog of db_engine, reloading it first if it expired
+    :param db_engine: Specifies the connection to the database
+    :return: A _Catalog instance, or None if cache_catalog wasn't called on db_engine
+    """
+    with _catalogs_lock:
+        catalog = _catalogs.get(id(db_engine))
+        if catalog is not None and catalog.expired():
+            catalog = _catalogs[id(db_engine)] = _load_catalog(db_engine, catalog.ttl)
+        return catalog
+
+
+@_instrumented
+def cache_catalog(db_engine, ttl=None):
+    """
+    Loads the list of tables and sequences in the database with one query, and answers has_table and tables_exist
+    from it from then on. The helpers of this module keep it up to date; changes made by anything else are picked up
+    after ttl seconds or on refresh_catalog.
+    :param db_engine: Specifies the connection to the database
+    :param ttl: Number of seconds after which the list is reloaded, or None to keep it until refresh_catalog
+    :return: None
+    """
+    with _catalogs_lock:
+        _catalogs[id(db_engine)] = _load_catalog(db_engine, ttl)
+
+
+@_instrumented
+def uncache_catalog(db_engine):
+    """
+    Stops caching the catalog of db_engine (see cache_catalog); has_table and tables_exist query the database again
+    :param db_engine: Specifies the connection to the database
+    :return: None
+    """
+    with _catalogs_lock:
+        _catalogs.pop(id(db_engine), None)
+
+
+@_instrumented
+def refresh_catalog(db_engine):
+    """
+    Reloads the catalog cached by cache_catalog on the next lookup
+    :param db_engine: Specifies the connection to the database
+    :return: None
+    """
+    with _catalogs_lock:
+        catalog = _catalogs.get(id(db_engine))
+        if catalog is not None:
+            catalog.stale = True
+
+
+def _update_catalog(db_engine, table_name, exists, partitioned=False):
+    """
+    Records a table (or sequence) created or dropped by this module in the cached catalog, if there is one
+    :param db_engine: Specifies the connection to the database
+    :param table_name: Name of the table (table_name or schema.table_name); plain names are resolved against the
+    search_path the catalog was loaded with
+    :param exists: True if the table was created, False if it was dropped
+    :param partitioned: True if a partitioned table was created
+    :return: None
+    """
+    with _catalogs_lock:
+        catalog = _catalogs.get(id(db_engine))
+        if catalog is not None and not catalog.update(table_name, exists, partitioned):
+            catalog.stale = True
+
+
+def check_for_fixed_file(in_filename, out_filename, filelist, type):
+    """
+    Checks if file passed in is already fixed. If fixed, returns the file name; otherwise, calls the respective fix
+    function and returns the filename after the fix.
+    :param in_filename: The name of the file that need to be checked
+    :param out_filename: The name of the fixed file to be written
+    :param filelist: A list of strings of the filenames of the files that need to be parsed
+    :param type: Integer, specifies the type of the source file (1 for animal, 2 for active animal, 5&6 for events)
+    :return: Filename of the fixed file, or None if the fixed file is already in filelist
+    """
+    # if this one isn't fixed
+    if os.path.basename(in_filename).split('.')[-1] == 'fixed':
+        return in_filename
+    else:
+        # and there isn't an equivilant fixed file in the list
+        if in_filename + ".fixed" not in filelist:
+            # create a fixed file
+            if type == 1 or type == 2:
+                return fix_animal_file(in_filename, out_filename)
+            elif type == 5 or type == 6:
+                return fix_event_file(in_filename, out_filename)
+            else:
+                logger.error("Bad file: File type not supported (should be animal/active_animal/event)")
+                exit(1)
+        else:
+            # it'll get to the fixed on on it's own
+            return None
+
+
+def _fix_irregular_row(row, num_columns, shrink, rejects):
+    """
+    Deals with a row (without its trailing empty column) that doesn't have num_columns columns: over-long rows are
+    shrunk, short rows are rejected (or end the process)
+    :param row: List of strings, modified in place
+    :param num_columns: Number of columns the row should have
+    :param shrink: shrink_animal_row or shrink_row
+    :param rejects: Optional list that short rows are appended to instead of ending the process
+    :return: The row, or None if it has to be skipped
+    """
+    if len(row) > num_columns:
+        logger.debug("unshrunk row: %s", row)
+        shrink(row, num_columns)
+        logger.debug("shrunk row: %s", row)
+        return row
+    if rejects is not None:
+        logger.warning("Skipping row with too few columns: %s", row)
+        rejects.append(row)
+        return None
+    logger.error("Row has too few columns!")
+    logger.error("row = %s", row)
+    exit(1)
+
+
+def _fix_file(in_filename, out_filename, reject_filename, shrink, skip_totals):
+    """
+    Writes a fixed copy of a DairyComp export, the same as writing the rows of fix_animal_rows / fix_event_rows with a
+    csv.writer. Well-formed rows without quotes (nearly all of them) are fixed as strings, without being parsed and
+    written again by the csv module; every other row takes the csv module's path.
+    :param in_filename: The name of the file to be fixed
+    :param out_filename: The name of the fixed file to be written
+    :param reject_filename: Optional file that rows with too few columns are written to, instead of ending the process
+    :param shrink: shrink_animal_row or shrink_row
+    :param skip_totals: If True, the 'Total' rows are left out (animal exports)
+    :return: out_filename
+    """
+    rejects = [] if reject_filename is not None else None
+    strip = str.strip
+    with _open_output(out_filename) as out_csv:
+        csv_writer = csv.writer(out_csv, delimiter=',')
+        write = out_csv.write
+        with _open_csv(in_filename, binary=False) as in_csv:
+            lines = iter(in_csv)
+            num_columns = 0
+            for line in lines:
+                # one comma per column, since every row ends with an empty column
+                if line.count(',') == num_columns and num_columns and '"' not in line and not (
+                        skip_totals and line.startswith('Total')):
+                    fields = line.split(',')
+                    fields.pop()  # the trailing empty column, with the newline
+                    write(','.join(map(strip, fields)) + '\r\n')
+                    continue
+                # the csv module reads further lines if a quoted value spans several
+                row = next(csv.reader(itertools.chain((line,), lines), delimiter=','))
+                row.pop()
+                if skip_totals and row[0].startswith('Total'):
+                    continue
+                if len(row) != num_columns:
+                    if num_columns == 0:
+                        num_columns = len(row)
+                        logger.debug("Set row count to: %d", num_columns)
+                    elif _fix_irregular_row(row, num_columns, shrink, rejects) is None:
+                        continue
+                csv_writer.writerow(list(map(strip, row)))
+    if reject_filename is not None:
+        with open(reject_filename, "w") as reject_csv:
+            csv.writer(reject_csv, delimiter=',').writerows(rejects)
+    return out_filename
+
+
+def fix_animal_rows(rows, rejects=None):
+    """
+    Fixes the rows of a DairyComp animal export: drops the trailing empty column and the 'Total' rows, folds over-long
+    remarks back into one column and strips every value
+    :param rows: Iterable of rows (lists of strings), e.g. a csv.reader, starting with the header row
+    :param rejects: Optional list; rows with too few columns are appended to it and skipped instead of ending the
+    process
+    :return: Generator of fixed rows, starting with the header row
+    """
+    strip = str.strip
+    num_columns = 0
+    for row in rows:
+        row.pop()
+        if row[0].startswith('Total'):
+            continue
+        if len(row) != num_columns:  # the common case (a well-formed row) skips all the checks below
+            if num_columns == 0:
+                num_columns = len(row)
+                logger.debug("Set row count to: %d", num_columns)
+            elif _fix_irregular_row(row, num_columns, shrink_animal_row, rejects) is None:
+                continue
+        yield list(map(strip, row))
+
+
+@_instrumented
+def fix_animal_file(in_filename, out_filename, reject_filename=None):
+    """
+    Writes a fixed copy of a DairyComp animal export (see fix_animal_rows)
+    :param in_filename: The name of the file to be fixed; gzip, bz2 and zstd files are decompressed on the fly
+    :param out_filename: The name of the fixed file to be written; compressed if it ends with .gz, .bz2 or .zst
+    :param reject_filename: Optional file that rows with too few columns are written to, instead of ending the process
+    :return: out_filename
+    """
+    return _fix_file(in_filename, out_filename, reject_filename, shrink_animal_row, skip_totals=True)
+
+
+def shrink_animal_row(row, num_columns):
+    """
+    Folds the extra columns of an animal row (a remark that contained commas) back into the remark column
+    :param row: List of strings, modified in place
+    :param num_columns: Number of columns the row should have
+    :return: The shrunk row
+    """
+    return _fold_remark(row, num_columns, 15)
+
+
+def fix_event_rows(rows, rejects=None):
+    """
+    Fixes the rows of a DairyComp event export: drops the trailing empty column, folds over-long remarks back into
+    one column and strips every value
+    :param rows: Iterable of rows (lists of strings), e.g. a csv.reader, starting with the header row
+    :param rejects: Optional list; rows with too few columns are appended to it and skipped instead of ending the
+    process
+    :return: Generator of fixed rows, starting with the header row
+    """
+    strip = str.strip
+    num_columns = 0
+    for row in rows:
+        row.pop()
+        if len(row) != num_columns:  # the common case (a well-formed row) skips all the checks below
+            if num_columns == 0:
+                num_columns = len(row)
+                logger.debug("Set row count to: %d", num_columns)
+            elif _fix_irregular_row(row, num_columns, shrink_row, rejects) is None:
+                continue
+        yield list(map(strip, row))
+
+
+@_instrumented
+def fix_event_file(in_filename, out_filename, reject_filename=None):
+    """
+    Writes a fixed copy of a DairyComp event export (see fix_event_rows)
+    :param in_filename: The name of the file to be fixed; gzip, bz2 and zstd files are decompressed on the fly
+    :param out_filename: The name of the fixed file to be written; compressed if it ends with .gz, .bz2 or .zst
+    :param reject_filename: Optional file that rows with too few columns are written to, instead of ending the process
+    :return: out_filename
+    """
+    return _fix_file(in_filename, out_filename, reject_filename, shrink_row, skip_totals=False)
+
+
+def shrink_row(row, num_columns):
+    """
+    Folds the extra columns of an event row (a remark that contained commas) back into the remark column
+    :param row: List of strings, modified in place
+    :param num_columns: Number of columns the row should have
+    :return: The shrunk row
+    """
+    return _fold_remark(row, num_columns, 8)
+
+
+def _fold_remark(row, num_columns, remark_column):
+    """
+    Joins the extra columns that follow remark_column into it, in one slice operation
+    :param row: List of strings, modified in place
+    :param num_columns: Number of columns the row should have
+    :param remark_column: Index of the remark column
+    :return: The shrunk row
+    """
+    # how many extra rows?
+    extra_row_count = len(row) - num_columns
+    if extra_row_count > 0:
+        end = remark_column + 1 + extra_row_count
+        remark = row[remark_column] + " " + "".join(row[remark_column + 1:end])
+        del row[remark_column + 1:end]
+        row[remark_column] = remark
+    return row
+
+
+@_instrumented
+def fix_files(jobs, filelist, workers=None):
+    """
+    Runs check_for_fixed_file on several DairyComp exports at once, one file per process
+    :param jobs: List of (in_filename, out_filename, type) tuples, as passed to check_for_fixed_file
+    :param filelist: A list of strings of the filenames of the files that need to be parsed
+    :param workers: Number of processes; defaults to the number of CPUs
+    :return: List with the return value of check_for_fixed_file for every job, in the same order
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(check_for_fixed_file, in_filename, out_filename, filelist, file_type)
+                   for in_filename, out_filename, file_type in jobs]
+        return [future.result() for future in futures]
+
+
+class RowStream:
+    """
+    Read-only file-like object that renders rows as csv lines on demand, so a generator of rows can be passed
+    straight to cursor.copy_from without writing a file first. Optionally writes the same lines to a side file.
+    """
+
+    def __init__(self, rows, skip_header=True, side_output=None):
+        """
+        :param rows: Iterable of rows (lists of strings)
+        :param skip_header: If True, the first row is not returned by read() (it is still written to side_output)
+        :param side_output: Optional text file object that receives every row, header included
+        """
+        self.rows = iter(rows)
+        self.side_output = side_output
+        self.buffer = io.StringIO()
+        self.csv_writer = csv.writer(self.buffer, delimiter=',')
+        self.pending = ""
+        if skip_header:
+            self._render(1)
+            self.pending = ""
+
+    def _render(self, count):
+        """
+        Renders up to count rows into self.pending
+        :param count: Number of rows to render
+        :return: False once the rows are exhausted
+        """
+        for row in itertools.islice(self.rows, count):
+            self.csv_writer.writerow(row)
+        lines = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        if self.side_output is not None:
+            self.side_output.write(lines)
+        self.pending += lines
+        return lines != ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.pending) < size:
+            if not self._render(1000):
+                break
+        if size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def readline(self, size=-1):
+        while "\n" not in self.pending:
+            if not self._render(1):
+                break
+        end = self.pending.find("\n") + 1 or len(self.pending)
+        if 0 <= size < end:
+            end = size
+        data, self.pending = self.pending[:end], self.pending[end:]
+        return data
+
+
+@_instrumented
+def fix_and_populate_table(table_name, in_filename, file_type, db_engine, fixed_filename=None):
+    """
+    Fixes a DairyComp export and copies the fixed rows straight into a table, without writing a fixed file first
+    :param table_name: Name of the table that needs to be populated
+    :param in_filename: The name of the DairyComp export to be loaded
+    :param file_type: Integer, specifies the type of the source file (1 for animal, 2 for active animal, 5&6 for events)
+    :param db_engine: Specifies the connection to the database
+    :param fixed_filename: Optional name of a fixed file to write alongside the load (for debugging)
+    :return: Number of rows loaded
+    """
+    if file_type == 1 or file_type == 2:
+        fix_rows = fix_animal_rows
+    elif file_type == 5 or file_type == 6:
+        fix_rows = fix_event_rows
+    else:
+        logger.error("Bad file: File type not supported (should be animal/active_animal/event)")
+        exit(1)
+
+    side_output = _open_output(fixed_filename) if fixed_filename is not None else None
+    try:
+        with _open_csv(in_filename, binary=False) as in_csv:
+            stream = RowStream(fix_rows(csv.reader(in_csv, delimiter=',')), side_output=side_output)
+            return populate_table_from_stream(table_name, stream, db_engine, in_filename)
+    finally:
+        if side_output is not None:
+            side_output.close()
@@ -0,0 +1,292 @@
+"""
+Asyncio counterparts of the DairyBrainUtils functions, built on SQLAlchemy's async engine and asyncpg.
+
+Unlike the functions in DairyBrainUtils, these raise exceptions instead of calling exit(1), so one failed load doesn't
+take down every other load running on the same event loop.
+"""
+import asyncio
+import logging
+import weakref
+from sqlalchemy.engine import URL
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.sql import text
+
+from DairyBrainUtils import _engine_key, _search_path
+
+logger = logging.getLogger(__name__)
+
+# registries of async engines, keyed by normalized credentials, one per event loop (asyncpg connections can only be
+# used on the loop they were opened on); engines created outside of a running loop go in _unbound_engines
+_engines = weakref.WeakKeyDictionary()
+_unbound_engines = {}
+
+
+def _loop_engines():
+    """
+    Returns the registry of engines of the running event loop
+    :return: Dictionary of normalized credentials -> AsyncEngine
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:  # called outside of a coroutine
+        return _unbound_engines
+    engines = _engines.get(loop)
+    if engines is None:
+        engines = _engines[loop] = {}
+    return engines
+
+
+def get_engine(credentials):
+    """
+    Use sqlalchemy to create an async engine instance (with the asyncpg driver). Engines are cached per event loop, so
+    repeated calls on the same loop with the same credentials return the same engine, and a new loop (e.g. another
+    asyncio.run) gets engines of its own. An engine created outside of a running loop must only be used on one loop.
+    :param credentials: Dictionary with the same keys as for DairyBrainUtils.get_engine
+    :return: An AsyncEngine instance
+    """
+    engines = _loop_engines()
+    key = _engine_key(credentials)
+    db_engine = engines.get(key)
+    if db_engine is not None:
+        return db_engine
+
+    connect_args = {}
+    if credentials.get("statement_timeout") is not None:
+        # statement_timeout is given in milliseconds
+        connect_args["server_settings"] = {"statement_timeout": str(int(credentials["statement_timeout"]))}
+
+    db_engine = create_async_engine(
+        URL.create(
+            drivername=credentials["dialect"].split("+")[0] + "+asyncpg",
+            username=credentials["user"],
+            password=credentials["password"],
+            host=credentials["host"],
+            port=int(credentials["port"]),
+            database=credentials["db_name"],
+        ),
+        echo=credentials["log"],
+        pool_size=credentials.get("pool_size", 5),
+        max_overflow=credentials.get("max_overflow", 10),
+        pool_pre_ping=credentials.get("pre_ping", False),
+        pool_recycle=credentials.get("recycle", -1),
+        connect_args=connect_args,
+    )
+    engines[key] = db_engine
+    return db_engine
+
+
+async def dispose_all():
+    """
+    Disposes the engines that get_engine created on the running event loop (and outside of any loop), and removes
+    them from the registry
+    :return: None
+    """
+    engines = _loop_engines()
+    disposed = list(engines.values()) + list(_unbound_engines.values())
+    engines.clear()
+    _unbound_engines.clear()
+    for db_engine in disposed:
+        await db_engine.dispose()
+
+
+async def run_bounded(coroutines, limit=10):
+    """
+    Runs coroutines concurrently, with at most limit of them running at a time
+    :param coroutines: Iterable of coroutines, e.g. one load per farm
+    :param limit: Maximum number of coroutines running at once
+    :return: List of their results, in order
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def bounded(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(bounded(coroutine) for coroutine in coroutines))
+
+
+async def execute_statement(statement, db_engine):
+    """
+    Executes a SQL statement in the database
+    :param statement: String; SQL statement
+    :param db_engine: Specifies the connection to the database
+    :return: None
+    """
+    try:
+        async with db_engine.begin() as con:
+            await con.execute(text(statement))
+    except Exception:
+        logger.error("Error executing statement {}".format(statement))
+        raise
+
+
+async def has_table(table_name, db_engine):
+    """
+    Checks if a table with table_name is in the database
+    :param table_name: Name of the table that needs to be checked
+    :param db_engine: Specifies the connection to the database
+    :return: True if table with table_name is in the database, False otherwise
+    """
+    if '.' in table_name:  # received schema.table_name
+        schema_name, table_name = table_name.split('.', 1)
+    else:  # received plain table_name
+        schema_name = None
+    async with db_engine.connect() as con:
+        return await con.run_sync(lambda sync_con: sync_con.dialect.has_table(sync_con, table_name, schema_name))
+
+
+async def drop_table(table_name, db_engine):
+    """
+    Drops a table from the database
+    :param table_name: Name of the table that needs to be dropped
+    :param db_engine: Specifies the connection to the database
+    :return: None
+    """
+    try:
+        async with db_engine.begin() as con:
+            await con.execute(text("DROP TABLE IF EXISTS {};".format(table_name)))
+    except Exception:
+        logger.error("Error deleting table " + table_name + " from database!")
+        raise
+
+
+async def create_table(db_engine, table_name, sql_statement):
+    """
+    Creates a table with table_name in the database, dropping it first if it already exists
+    :param db_engine: Specifies the connection to the database
+    :param table_name: Name of the table that needs to be created
+    :param sql_statement: SQL statement with the column headers of the table, with {} in place of the table name
+    :return: None
+    """
+    try:
+        async with db_engine.begin() as con:
+            logger.info("Creating table " + table_name + " in " + db_engine.url.database + " database...")
+            await con.execute(text("DROP TABLE IF EXISTS {};".format(table_name)))
+            await con.execute(text(sql_statement.format(table_name)))
+    except Exception:
+        logger.error("Error creating the table " + table_name + " in " + db_engine.url.database + " database!")
+        raise
+
+
+async def create_table_if_doesnt_exist(db_engine, table_name, sql_statement):
+    """
+    Creates a table with table_name in the database if a table with the given name doesn't exist
+    :param db_engine: Specifies the connection to the database
+    :param table_name: Name of the table that needs to be created
+    :param sql_statement: SQL statement with the column headers of the table, with {} in place of the table name
+    :return: None
+    """
+    if not await has_table(table_name, db_engine):
+        try:
+            async with db_engine.begin() as con:
+                logger.info("Creating table " + table_name + " in " + db_engine.url.database + " database...")
+                await con.execute(text(sql_statement.format(table_name)))
+        except Exception:
+            logger.error("Error creating the table " + table_name + " in " + db_engine.url.database + " database!")
+            raise
+
+
+async def create_schema(db_engine, schema_name):
+    """
+    Creates a schema in the database
+    :param db_engine: Specifies the connection to the database
+    :param schema_name: Name of the schema to be created
+    :return: None
+    """
+    await execute_statement("CREATE SCHEMA IF NOT EXISTS " + schema_name + ";", db_engine)
+
+
+async def create_sequence(db_engine, sequence_name):
+    """
+    Creates a sequence in the database
+    :param db_engine: Specifies the connection to the database
+    :param sequence_name: Name of the sequence to be created
+    :return: None
+    """
+    await execute_statement("CREATE SEQUENCE IF NOT EXISTS " + sequence_name + ";", db_engine)
+
+
+async def get_next_from_sequence(db_engine, sequence_name):
+    """
+    Returns the next id in the given sequence (assuming one exists)
+    :param db_engine: Specifies the connection to the database
+    :param sequence_name: Name of the sequence
+    :return: The next id
+    """
+    return (await get_ids_from_sequence(db_engine, sequence_name, 1))[0]
+
+
+async def get_ids_from_sequence(db_engine, sequence_name, n):
+    """
+    Returns the next n ids in the given sequence (assuming one exists), using a single query
+    :param db_engine: Specifies the connection to the database
+    :param sequence_name: Name of the sequence
+    :param n: Number of ids wanted
+    :return: List of n ids, in increasing order
+    """
+    try:
+        async with db_engine.begin() as con:
+            result = await con.execute(text("SELECT nextval(:sequence_name) FROM generate_series(1, :n);"),
+                                       {"sequence_name": sequence_name, "n": n})
+            return sorted(row[0] for row in result)
+    except Exception:
+        logger.error("Error getting ids from sequence " + sequence_name + "!")
+        raise
+
+
+async def populate_table_from_stream(table_name, stream, db_engine):
+    """
+    Populates a table with the rows of an async stream, using COPY
+    :param table_name: Name of the table that needs to be populated (table_name or schema.table_name); plain names are
+    resolved like in DairyBrainUtils (dairy_comp, or the schema set with DairyBrainUtils.target_schema, then public)
+    :param stream: Async iterable of bytes with comma separated rows (without a header row)
+    :param db_engine: Specifies the connection to the database
+    :return: Number of rows copied
+    """
+    search_path = _search_path()  # taken before the first await, while the caller's target_schema applies
+    if '.' in table_name:  # received schema.table_name
+        schema_name, relation_name = table_name.split('.', 1)
+    else:  # received plain table_name
+        schema_name, relation_name = None, table_name
+    try:
+        async with db_engine.begin() as con:
+            await con.execute(text("SET LOCAL search_path TO " + search_path))
+            raw_connection = await con.get_raw_connection()
+            status = await raw_connection.driver_connection.copy_to_table(
+                relation_name, source=stream, schema_name=schema_name, format='text', delimiter=',', null='')
+    except Exception:
+        logger.error("Error importing the table " + table_name + " in " + db_engine.url.database + " database!")
+        raise
+    # asyncpg returns the command tag, e.g. 'COPY 42'
+    return int(status.split()[-1])
+
+
+async def _read_file(csv_location, block_size=1 << 20):
+    """
+    Reads a csv file without its header row, in blocks, without blocking the event loop
+    :param csv_location: Location of the csv file
+    :param block_size: Number of bytes read at a time
+    :return: Async generator of bytes
+    """
+    loop = asyncio.get_running_loop()
+    f = await loop.run_in_executor(None, open, csv_location, 'rb')
+    try:
+        await loop.run_in_executor(None, f.readline)  # Skip the header row.
+        while True:
+            block = await loop.run_in_executor(None, f.read, block_size)
+            if not block:
+                break
+            yield block
+    finally:
+        f.close()
+
+
+async def populate_table_from_csv(table_name, csv_location, db_engine):
+    """
+    Populates a table with the contents of a csv file
+    :param table_name: Name of the table that needs to be populated
+    :param csv_location: Location of the csv file
+    :param db_engine: Specifies the connection to the database
+    :return: Number of rows copied
+    """
+    return await populate_table_from_stream(table_name, _read_file(csv_location), db_engine)
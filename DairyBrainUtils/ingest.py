@@ -0,0 +1,298 @@
+"""
+Loads the DairyComp exports of many farms at once, as a pipeline: exports are fixed on a pool of processes while the
+fixed files are copied into the database over a pool of connections, each farm into a schema of its own.
+
+Also available from the command line as dairybrain-load (see main).
+"""
+import argparse
+import collections
+import csv
+import functools
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import DairyBrainUtils
+from DairyBrainUtils import _open_csv, _quote
+
+logger = logging.getLogger(__name__)
+
+# table each type of DairyComp export is loaded into (types as in check_for_fixed_file)
+TABLES = {1: "animals", 2: "active_animals", 5: "events", 6: "events"}
+
+# one DairyComp export of one farm
+Export = collections.namedtuple("Export", ["farm", "file", "type"])
+
+
+def file_type(file_name):
+    """
+    Reads the type of a DairyComp export from the number at the end of its name, e.g. 5 for events_5.csv.gz
+    :param file_name: Name of the export
+    :return: Integer, or None if the name doesn't end with a number
+    """
+    match = re.search(r"(\d+)$", os.path.basename(file_name).split('.')[0])
+    return int(match.group(1)) if match else None
+
+
+def find_exports(directory):
+    """
+    Lists the exports in a directory with one subdirectory per farm (named after the farm)
+    :param directory: Location of the directory
+    :return: List of Export, ordered by farm and file name
+    """
+    exports = []
+    for farm in sorted(os.listdir(directory)):
+        farm_directory = os.path.join(directory, farm)
+        if not os.path.isdir(farm_directory):
+            continue
+        for file_name in sorted(os.listdir(farm_directory)):
+            if ".fixed" in file_name or ".rejects" in file_name:  # output of an earlier run
+                continue
+            export_type = file_type(file_name)
+            if export_type in TABLES:
+                exports.append(Export(farm, os.path.join(farm_directory, file_name), export_type))
+            else:
+                logger.warning("Skipping " + os.path.join(farm_directory, file_name) + ": unknown export type")
+    return exports
+
+
+def read_manifest(manifest):
+    """
+    Reads the exports listed in a csv manifest with the columns farm, file and optionally type (by default read from
+    the file name, see file_type). Relative file locations are relative to the manifest.
+    :param manifest: Location of the manifest
+    :return: List of Export
+    """
+    exports = []
+    with open(manifest, newline='') as f:
+        for row in csv.DictReader(f):
+            file_name = os.path.join(os.path.dirname(os.path.abspath(manifest)), row["file"])
+            export_type = int(row["type"]) if row.get("type") else file_type(file_name)
+            if export_type not in TABLES:
+                raise ValueError("Unknown export type of " + file_name + " in " + manifest)
+            exports.append(Export(row["farm"], file_name, export_type))
+    return exports
+
+
+def schema_name(farm, prefix=""):
+    """
+    Returns the schema a farm is loaded into: the farm name, lowercased, with anything but letters, digits and
+    underscores replaced by underscores
+    :param farm: Name of the farm
+    :param prefix: Optional prefix of the schema name, e.g. 'farm_'
+    :return: Schema name
+    """
+    name = prefix + re.sub(r"\W", "_", farm.strip().lower())
+    return "farm_" + name if name[0].isdigit() else name
+
+
+def table_ddl(fixed_filename):
+    """
+    Builds the CREATE TABLE statement of an export from the header row of its fixed file, with a text column per
+    header
+    :param fixed_filename: Location of the fixed export
+    :return: SQL statement with {} in place of the table name
+    """
+    with _open_csv(fixed_filename, binary=False) as f:
+        header = next(csv.reader(f))
+    columns = []
+    for column in header:
+        column = re.sub(r"\W", "_", column.strip().lower()) or "column"
+        name, suffix = column, 2
+        while name in columns:  # DairyComp repeats headers, e.g. two DIM columns
+            name, suffix = "{}_{}".format(column, suffix), suffix + 1
+        columns.append(name)
+    return "CREATE TABLE {} (" + ", ".join(_quote(column) + " text" for column in columns) + ");"
+
+
+def _describe(e):
+    """
+    Describes why an export failed
+    :param e: The exception, or the SystemExit of a helper that called exit(1) (whose error was logged already)
+    :return: String
+    """
+    if isinstance(e, SystemExit):
+        return "exited with status {} (see the errors logged above)".format(e.code)
+    return str(e) or type(e).__name__
+
+
+def _fixed_location(export, fixed_dir, fixed_suffix):
+    """
+    Returns where the fixed copy of an export is written
+    :param export: Export
+    :param fixed_dir: Directory for the fixed files (one subdirectory per farm), or None to write them next to the
+    exports
+    :param fixed_suffix: Appended to the name of the export, e.g. '.fixed' or '.fixed.gz'
+    :return: Location of the fixed file
+    """
+    if fixed_dir is None:
+        return export.file + fixed_suffix
+    farm_directory = os.path.join(fixed_dir, export.farm)
+    os.makedirs(farm_directory, exist_ok=True)
+    return os.path.join(farm_directory, os.path.basename(export.file) + fixed_suffix)
+
+
+def load_farms(exports, credentials, fix_workers=None, load_workers=4, max_pending=None, schema_prefix="",
+               replace=True, max_rejects=None, fixed_dir=None, fixed_suffix=".fixed", progress=None):
+    """
+    Fixes and loads the exports of many farms concurrently. Exports are fixed on fix_workers processes; each fixed file
+    is then copied into <farm schema>.<table> (see schema_name and TABLES) on one of load_workers connections, while
+    the next exports are being fixed. A failed export is reported and doesn't stop the others.
+    :param exports: List of Export, e.g. from find_exports or read_manifest
+    :param credentials: Dictionary of credentials, as for DairyBrainUtils.get_engine
+    :param fix_workers: Number of processes fixing exports; defaults to the number of CPUs
+    :param load_workers: Number of exports copied into the database at once
+    :param max_pending: Maximum number of exports being fixed or waiting to be loaded (back-pressure, so fixing can't
+    run far ahead of loading); defaults to twice load_workers
+    :param schema_prefix: Prefix of the farm schemas
+    :param replace: If True, the tables are dropped and created again before the first export is loaded into them;
+    otherwise they are created if they don't exist and the rows are appended
+    :param max_rejects: If given, rows the database refuses are set aside, up to this many per export (see
+    DairyBrainUtils.populate_table_from_csv)
+    :param fixed_dir: Directory for the fixed files (one subdirectory per farm); by default they are written next to
+    the exports
+    :param fixed_suffix: Appended to the names of the fixed files; '.fixed.gz' compresses them
+    :param progress: Optional function called with the result of each export as it finishes
+    :return: List with one dictionary per export, in order, with the keys: [farm, file, table, status, rows, rejected,
+    seconds, error], where status is loaded or failed
+    """
+    max_pending = max_pending or 2 * load_workers
+    db_engine = DairyBrainUtils.get_engine(dict(credentials, pool_size=max(credentials.get("pool_size", 5),
+                                                                          load_workers)))
+    pending = threading.BoundedSemaphore(max_pending)
+    results = [None] * len(exports)
+    finished = []
+    report_lock = threading.Lock()
+    ddl_lock = threading.Lock()  # concurrent CREATE SCHEMA IF NOT EXISTS can fail, so DDL is serialized
+    prepared = set()
+    started = time.perf_counter()
+
+    def report(index, result):
+        with report_lock:
+            results[index] = result
+            finished.append(result)
+            rows = sum(result["rows"] for result in finished)
+            seconds = time.perf_counter() - started
+            if result["status"] == "loaded":
+                logger.info("[{}/{}] Loaded {} into {}: {} rows in {:.1f}s ({:.0f} rows/sec overall)".format(
+                    len(finished), len(exports), result["file"], result["table"], result["rows"], result["seconds"],
+                    rows / seconds if seconds else 0.0))
+            else:
+                logger.error("[{}/{}] Failed to load {} into {}: {}".format(
+                    len(finished), len(exports), result["file"], result["table"], result["error"]))
+        if progress is not None:
+            progress(result)
+
+    def load(index, export, fixed_filename, fix_started):
+        schema = schema_name(export.farm, schema_prefix)
+        table_name = schema + "." + TABLES[export.type]
+        result = {"farm": export.farm, "file": export.file, "table": table_name, "status": "failed", "rows": 0,
+                  "rejected": 0, "seconds": 0.0, "error": None}
+        try:
+            with ddl_lock:
+                if table_name not in prepared:
+                    DairyBrainUtils.create_schema(db_engine, schema)
+                    create = DairyBrainUtils.create_table if replace else DairyBrainUtils.create_table_if_doesnt_exist
+                    create(db_engine, table_name, table_ddl(fixed_filename))
+                    prepared.add(table_name)
+            with DairyBrainUtils.target_schema(schema):
+                copied = DairyBrainUtils.populate_table_from_csv(table_name, fixed_filename, db_engine,
+                                                                 max_rejects=max_rejects)
+            if max_rejects is None:
+                result["rows"] = copied
+            else:
+                result["rows"], result["rejected"] = copied["rows"], copied["rejected"]
+            result["status"] = "loaded"
+        except (Exception, SystemExit) as e:  # the helpers exit(1) on errors
+            result["error"] = _describe(e)
+        finally:
+            result["seconds"] = time.perf_counter() - fix_started
+            pending.release()
+        report(index, result)
+
+    def fixed(index, export, fix_started, future):
+        # runs as soon as the export is fixed, and hands it over to the loaders
+        try:
+            fixed_filename = future.result()
+        except BaseException as e:  # the fixers exit(1) on errors
+            pending.release()
+            report(index, {"farm": export.farm, "file": export.file,
+                           "table": schema_name(export.farm, schema_prefix) + "." + TABLES[export.type],
+                           "status": "failed", "rows": 0, "rejected": 0,
+                           "seconds": time.perf_counter() - fix_started,
+                           "error": "fixing failed: " + _describe(e)})
+            return
+        loaders.submit(load, index, export, fixed_filename, fix_started)
+
+    logger.info("Loading {} exports of {} farms with {} fixing processes and {} connections".format(
+        len(exports), len({export.farm for export in exports}), fix_workers or os.cpu_count(), load_workers))
+    with ThreadPoolExecutor(max_workers=load_workers) as loaders:
+        with ProcessPoolExecutor(max_workers=fix_workers) as fixers:
+            for index, export in enumerate(exports):
+                pending.acquire()  # wait while max_pending exports are fixed but not loaded yet
+                future = fixers.submit(DairyBrainUtils.check_for_fixed_file, export.file,
+                                       _fixed_location(export, fixed_dir, fixed_suffix), [], export.type)
+                future.add_done_callback(functools.partial(fixed, index, export, time.perf_counter()))
+        # every export holds the semaphore until it is loaded (or failed)
+        for _ in range(max_pending):
+            pending.acquire()
+
+    loaded = [result for result in results if result["status"] == "loaded"]
+    logger.info("Loaded {} of {} exports ({} rows) in {:.1f}s".format(
+        len(loaded), len(exports), sum(result["rows"] for result in loaded), time.perf_counter() - started))
+    return results
+
+
+def main(argv=None):
+    """
+    Entry point of dairybrain-load: loads a directory of farm exports (one subdirectory per farm) or the exports listed
+    in a csv manifest (see read_manifest)
+    :param argv: Command line arguments; defaults to sys.argv[1:]
+    :return: None; exits with status 1 if an export failed
+    """
+    parser = argparse.ArgumentParser(prog="dairybrain-load",
+                                     description="Fixes and loads the DairyComp exports of many farms concurrently.")
+    parser.add_argument("source", help="directory with one subdirectory of exports per farm, or a csv manifest with "
+                                       "the columns farm, file and (optionally) type")
+    parser.add_argument("--host", default=os.environ.get("PGHOST", "localhost"))
+    parser.add_argument("--port", default=os.environ.get("PGPORT", "5432"))
+    parser.add_argument("--user", default=os.environ.get("PGUSER", "postgres"))
+    parser.add_argument("--password", default=os.environ.get("PGPASSWORD", ""))
+    parser.add_argument("--db-name", default=os.environ.get("PGDATABASE", "postgres"))
+    parser.add_argument("--schema-prefix", default="", help="prefix of the farm schemas")
+    parser.add_argument("--fix-workers", type=int, help="processes fixing exports (default: number of CPUs)")
+    parser.add_argument("--load-workers", type=int, default=4, help="exports copied into the database at once")
+    parser.add_argument("--max-pending", type=int,
+                        help="exports fixed ahead of loading at most (default: twice --load-workers)")
+    parser.add_argument("--max-rejects", type=int, help="set aside up to this many refused rows per export")
+    parser.add_argument("--append", action="store_true",
+                        help="append to existing tables instead of dropping and creating them again")
+    parser.add_argument("--fixed-dir", help="directory for the fixed files (default: next to the exports)")
+    parser.add_argument("--compress-fixed", action="store_true", help="gzip the fixed files")
+    parser.add_argument("--results", help="write the result of every export to this JSON file")
+    parser.add_argument("--quiet", action="store_true", help="only log errors")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR if args.quiet else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    exports = find_exports(args.source) if os.path.isdir(args.source) else read_manifest(args.source)
+    credentials = {"dialect": "postgresql", "user": args.user, "password": args.password, "host": args.host,
+                   "port": args.port, "db_name": args.db_name, "log": False}
+    results = load_farms(exports, credentials, fix_workers=args.fix_workers, load_workers=args.load_workers,
+                         max_pending=args.max_pending, schema_prefix=args.schema_prefix, replace=not args.append,
+                         max_rejects=args.max_rejects, fixed_dir=args.fixed_dir,
+                         fixed_suffix=".fixed.gz" if args.compress_fixed else ".fixed")
+    if args.results:
+        with open(args.results, "w") as f:
+            json.dump(results, f, indent=2)
+    if any(result["status"] != "loaded" for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Generates synthetic DairyComp animal and event exports for the benchmarks, in the shape the fixers expect: a trailing
+empty column on every row, 'Total' rows in animal exports, and a share of rows whose remark contains unquoted commas
+(so the row has extra columns that shrink_animal_row / shrink_row fold back).
+
+Usage: python benchmarks/generate_dairycomp.py --animals 10000 --events 100000 --out /tmp/dairycomp
+"""
+import argparse
+import datetime
+import os
+import random
+
+ANIMAL_COLUMNS = ["ID", "PEN", "LACT", "RC", "BDAT", "FDAT", "DDAT", "CDAT", "HDAT", "EID", "CBRD", "SID", "DID",
+                  "MGSIR", "DIM", "REMARK"]
+EVENT_COLUMNS = ["ID", "PEN", "LACT", "RC", "BDAT", "EVENT", "DIM", "DATE", "REMARK", "R", "T", "B"]
+EVENTS = ["FRESH", "BRED", "PREG", "OPEN", "DRY", "HEAT", "MAST", "LAME", "MOVE", "VACC", "SOLD", "DIED"]
+REMARKS = ["", "", "", "7HO12345", "OK", "LF", "RH TREATED", "ABORT 120", "SIRE 29HO1 REBRED", "CULL LIST"]
+# remarks with unquoted commas, which DairyComp exports as extra columns
+LONG_REMARKS = ["BRED TO,29HO17777", "LF,RR,TREATED", "MOVED PEN 3,THEN 7,THEN 9", "NOTE,CHECK,AGAIN,LATER"]
+
+ANIMAL_DDL = "CREATE TABLE {} (" + ", ".join(column.lower() + " text" for column in ANIMAL_COLUMNS) + ");"
+EVENT_DDL = "CREATE TABLE {} (" + ", ".join(column.lower() + " text" for column in EVENT_COLUMNS) + ");"
+
+
+def _date(rng, start=datetime.date(2010, 1, 1), days=5000):
+    """
+    Returns a random date in DairyComp's m/d/yy format
+    :param rng: random.Random instance
+    :param start: First possible date
+    :param days: Number of possible dates
+    :return: String
+    """
+    day = start + datetime.timedelta(days=rng.randrange(days))
+    return "{}/{}/{:02d}".format(day.month, day.day, day.year % 100)
+
+
+def _remark(rng, malformed):
+    """
+    Returns a remark, with unquoted commas for a malformed share of the rows
+    :param rng: random.Random instance
+    :param malformed: Share of rows with an over-long remark, between 0 and 1
+    :return: String
+    """
+    if rng.random() < malformed:
+        return rng.choice(LONG_REMARKS)
+    return rng.choice(REMARKS)
+
+
+def write_animal_export(path, rows, malformed=0.01, seed=0, totals_every=1000):
+    """
+    Writes a synthetic DairyComp animal export
+    :param path: Location of the file to be written
+    :param rows: Number of animals
+    :param malformed: Share of rows with an over-long remark, between 0 and 1
+    :param seed: Seed of the random generator, so the same arguments always give the same file
+    :param totals_every: A 'Total' row is written after this many animals (and at the end)
+    :return: path
+    """
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        f.write(",".join(ANIMAL_COLUMNS) + ",\n")
+        for animal_id in range(1, rows + 1):
+            f.write(",".join((
+                str(animal_id), str(rng.randrange(1, 40)), str(rng.randrange(0, 8)), str(rng.randrange(0, 9)),
+                _date(rng), _date(rng), _date(rng), _date(rng), _date(rng), "840" + str(rng.randrange(10 ** 12)),
+                rng.choice(("HO", "JE", "XB")), "SIRE" + str(rng.randrange(500)), str(rng.randrange(1, rows + 1)),
+                "MGS" + str(rng.randrange(500)), str(rng.randrange(0, 600)), _remark(rng, malformed))) + ",\n")
+            if animal_id % totals_every == 0 or animal_id == rows:
+                f.write("Total: " + str(animal_id) + "," * len(ANIMAL_COLUMNS) + "\n")
+    return path
+
+
+def write_event_export(path, rows, animals=10000, malformed=0.01, seed=0):
+    """
+    Writes a synthetic DairyComp event export
+    :param path: Location of the file to be written
+    :param rows: Number of events
+    :param animals: Number of distinct animal ids the events refer to
+    :param malformed: Share of rows with an over-long remark, between 0 and 1
+    :param seed: Seed of the random generator, so the same arguments always give the same file
+    :return: path
+    """
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        f.write(",".join(EVENT_COLUMNS) + ",\n")
+        for _ in range(rows):
+            f.write(",".join((
+                str(rng.randrange(1, animals + 1)), str(rng.randrange(1, 40)), str(rng.randrange(0, 8)),
+                str(rng.randrange(0, 9)), _date(rng), rng.choice(EVENTS), str(rng.randrange(0, 600)), _date(rng),
+                _remark(rng, malformed), str(rng.randrange(0, 4)), str(rng.randrange(0, 3)),
+                str(rng.randrange(0, 10)))) + ",\n")
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates synthetic DairyComp animal and event exports.")
+    parser.add_argument("--animals", type=int, default=10000, help="number of animal rows")
+    parser.add_argument("--events", type=int, default=100000, help="number of event rows")
+    parser.add_argument("--malformed", type=float, default=0.01, help="share of rows with over-long remarks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=".", help="directory the exports are written to")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    print(write_animal_export(os.path.join(args.out, "animals_1.csv"), args.animals, args.malformed, args.seed))
+    print(write_event_export(os.path.join(args.out, "events_5.csv"), args.events, args.animals, args.malformed,
+                             args.seed))
+
+
+if __name__ == "__main__":
+    main()
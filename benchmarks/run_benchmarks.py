@@ -0,0 +1,300 @@
+"""
+Benchmarks of DairyBrainUtils against a local PostgreSQL database. Results are written as JSON, so runs on different
+commits can be compared with --compare.
+
+Usage:
+    python benchmarks/run_benchmarks.py --events 1000000 --output results.json
+    python benchmarks/run_benchmarks.py --output new.json --compare results.json
+
+Connection settings default to the standard PG* environment variables. Everything is created in the
+dairybrainutils_bench schema, which is dropped before and after the run.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import DairyBrainUtils  # noqa: E402
+from generate_dairycomp import ANIMAL_DDL, EVENT_DDL, write_animal_export, write_event_export  # noqa: E402
+
+SCHEMA = "dairybrainutils_bench"
+
+# name -> function(context) returning (seconds, rows), where rows counts whatever the benchmark processes (rows, calls
+# or tables); filled by @benchmark, run in this order
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """
+    Registers a benchmark
+    :param func: Function taking the context dictionary and returning (seconds, rows)
+    :return: func
+    """
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def _timed(func, *args, **kwargs):
+    """
+    Calls func and returns how long it took
+    :return: Seconds
+    """
+    started = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - started
+
+
+@benchmark
+def fix_animal_file(context):
+    return _timed(DairyBrainUtils.fix_animal_file, context["animal_file"],
+                  os.path.join(context["data_dir"], "animals_1.csv.fixed")), context["animals"]
+
+
+@benchmark
+def fix_event_file(context):
+    return _timed(DairyBrainUtils.fix_event_file, context["event_file"],
+                  os.path.join(context["data_dir"], "events_5.csv.fixed")), context["events"]
+
+
+def _fixed_events(context):
+    """
+    Returns the fixed event export, fixing it first if needed
+    :return: Location of the fixed file
+    """
+    fixed = os.path.join(context["data_dir"], "events_5.csv.fixed")
+    if not os.path.exists(fixed):
+        DairyBrainUtils.fix_event_file(context["event_file"], fixed)
+    return fixed
+
+
+@benchmark
+def populate_table_from_csv(context):
+    fixed = _fixed_events(context)
+    DairyBrainUtils.create_table(context["engine"], SCHEMA + ".events", EVENT_DDL)
+    return _timed(DairyBrainUtils.populate_table_from_csv, SCHEMA + ".events", fixed,
+                  context["engine"]), context["events"]
+
+
+@benchmark
+def populate_table_from_csv_parallel(context):
+    fixed = _fixed_events(context)
+    DairyBrainUtils.create_table(context["engine"], SCHEMA + ".events", EVENT_DDL)
+    return _timed(DairyBrainUtils.populate_table_from_csv_parallel, SCHEMA + ".events", fixed, context["engine"],
+                  workers=context["workers"]), context["events"]
+
+
+def _next_ids(db_engine, sequence_name, n, block_size):
+    for _ in range(n):
+        DairyBrainUtils.get_next_from_sequence(db_engine, sequence_name, block_size)
+
+
+@benchmark
+def get_next_from_sequence(context):
+    return _timed(_next_ids, context["engine"], SCHEMA + ".ids", context["calls"], 1), context["calls"]
+
+
+@benchmark
+def get_next_from_sequence_block_1000(context):
+    return _timed(_next_ids, context["engine"], SCHEMA + ".ids", context["calls"], 1000), context["calls"]
+
+
+@benchmark
+def get_ids_from_sequence(context):
+    return _timed(DairyBrainUtils.get_ids_from_sequence, context["engine"], SCHEMA + ".ids",
+                  context["calls"]), context["calls"]
+
+
+def _has_tables(db_engine, n):
+    for i in range(n):
+        DairyBrainUtils.has_table(SCHEMA + (".events" if i % 2 else ".missing"), db_engine)
+
+
+@benchmark
+def has_table(context):
+    return _timed(_has_tables, context["engine"], context["calls"]), context["calls"]
+
+
+@benchmark
+def has_table_cached(context):
+    DairyBrainUtils.cache_catalog(context["engine"])
+    try:
+        return _timed(_has_tables, context["engine"], context["calls"]), context["calls"]
+    finally:
+        DairyBrainUtils.uncache_catalog(context["engine"])
+
+
+def _create_tables(db_engine, n):
+    DairyBrainUtils.create_schema(db_engine, SCHEMA)
+    for i in range(n):
+        DairyBrainUtils.create_table(db_engine, "{}.setup_{}".format(SCHEMA, i), ANIMAL_DDL)
+    DairyBrainUtils.create_sequence(db_engine, SCHEMA + ".setup_ids")
+
+
+def _create_tables_in_batch(db_engine, n):
+    with DairyBrainUtils.batch(db_engine, pipeline=True):
+        _create_tables(db_engine, n)
+
+
+@benchmark
+def ddl_setup(context):
+    return _timed(_create_tables, context["engine"], context["tables"]), context["tables"]
+
+
+@benchmark
+def ddl_setup_batch(context):
+    return _timed(_create_tables_in_batch, context["engine"], context["tables"]), context["tables"]
+
+
+def _commit():
+    """
+    Returns the git commit being benchmarked, or None outside a git checkout
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """
+    Runs the selected benchmarks
+    :param args: Parsed command line arguments
+    :return: Dictionary of results, as written to the JSON file
+    """
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="dairybrainutils_bench_")
+    os.makedirs(data_dir, exist_ok=True)
+    context = {
+        "engine": DairyBrainUtils.get_engine({
+            "dialect": "postgresql", "user": args.user, "password": args.password, "host": args.host,
+            "port": args.port, "db_name": args.db_name, "log": False, "pool_size": max(5, args.workers)}),
+        "data_dir": data_dir, "animals": args.animals, "events": args.events, "calls": args.calls,
+        "tables": args.tables, "workers": args.workers,
+        "animal_file": os.path.join(data_dir, "animals_1.csv"), "event_file": os.path.join(data_dir, "events_5.csv"),
+    }
+    print("Generating {} animals and {} events in {}".format(args.animals, args.events, data_dir))
+    write_animal_export(context["animal_file"], args.animals, args.malformed, args.seed)
+    write_event_export(context["event_file"], args.events, args.animals, args.malformed, args.seed)
+
+    db_engine = context["engine"]
+    with db_engine.connect() as con:
+        server_version = con.execute("SHOW server_version").scalar()
+
+    results = {}
+    selected = args.only or list(BENCHMARKS)
+    try:
+        for name in selected:
+            try:
+                DairyBrainUtils.execute_statement("DROP SCHEMA IF EXISTS {} CASCADE".format(SCHEMA), db_engine)
+                DairyBrainUtils.refresh_catalog(db_engine)
+                DairyBrainUtils.create_schema(db_engine, SCHEMA)
+                DairyBrainUtils.create_table(db_engine, SCHEMA + ".events", EVENT_DDL)
+                DairyBrainUtils.create_sequence(db_engine, SCHEMA + ".ids")
+                runs = [BENCHMARKS[name](context) for _ in range(args.repeat)]
+            except ImportError as e:  # an optional dependency (numpy, zstandard, asyncpg) isn't installed
+                results[name] = {"skipped": "{}: {}".format(type(e).__name__, e)}
+                print("{:<40} skipped ({})".format(name, results[name]["skipped"]))
+                continue
+            except (Exception, SystemExit) as e:  # the helpers exit(1) on database errors
+                # recorded as failed, so --compare counts it as a regression; the other benchmarks still run
+                results[name] = {"failed": "{}: {}".format(type(e).__name__, e)}
+                print("{:<40} FAILED ({})".format(name, results[name]["failed"]))
+                continue
+            seconds = [run_seconds for run_seconds, _ in runs]
+            rows = runs[0][1]
+            results[name] = {"rows": rows, "seconds": seconds, "best": min(seconds),
+                             "median": statistics.median(seconds), "rows_per_sec": rows / min(seconds)}
+            print("{:<40} {:>10.3f}s {:>14.0f}/s".format(name, min(seconds), rows / min(seconds)))
+    finally:
+        DairyBrainUtils.execute_statement("DROP SCHEMA IF EXISTS {} CASCADE".format(SCHEMA), db_engine)
+        if not args.data_dir:
+            shutil.rmtree(data_dir)
+
+    return {
+        "commit": _commit(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "postgres": server_version,
+        "parameters": {"animals": args.animals, "events": args.events, "malformed": args.malformed,
+                       "calls": args.calls, "tables": args.tables, "workers": args.workers, "repeat": args.repeat,
+                       "seed": args.seed},
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold):
+    """
+    Prints the change of every benchmark against a baseline run
+    :param baseline: Results of the baseline run
+    :param current: Results of this run
+    :param threshold: Ratio of best times above which a benchmark counts as a regression
+    :return: List of the names of the regressed benchmarks, including those that have a baseline result but failed
+    in this run
+    """
+    regressions = []
+    print("{:<40} {:>10} {:>10} {:>8}".format("benchmark", "baseline", "current", "ratio"))
+    for name, result in current["results"].items():
+        old = baseline["results"].get(name)
+        if old is None or "best" not in old:
+            continue
+        if "failed" in result:
+            print("{:<40} {:>10.3f} {:>10} {:>8}  REGRESSION".format(name, old["best"], "failed", "-"))
+            regressions.append(name)
+            continue
+        if "skipped" in result:
+            continue
+        ratio = result["best"] / old["best"]
+        print("{:<40} {:>10.3f} {:>10.3f} {:>8.2f}{}".format(name, old["best"], result["best"], ratio,
+                                                              "  REGRESSION" if ratio > threshold else ""))
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks DairyBrainUtils against a PostgreSQL database.")
+    parser.add_argument("--host", default=os.environ.get("PGHOST", "localhost"))
+    parser.add_argument("--port", default=os.environ.get("PGPORT", "5432"))
+    parser.add_argument("--user", default=os.environ.get("PGUSER", "postgres"))
+    parser.add_argument("--password", default=os.environ.get("PGPASSWORD", ""))
+    parser.add_argument("--db-name", default=os.environ.get("PGDATABASE", "postgres"))
+    parser.add_argument("--animals", type=int, default=10000, help="rows of the animal export")
+    parser.add_argument("--events", type=int, default=100000, help="rows of the event export (up to 50M)")
+    parser.add_argument("--malformed", type=float, default=0.01, help="share of rows with over-long remarks")
+    parser.add_argument("--calls", type=int, default=1000, help="calls of the sequence and has_table benchmarks")
+    parser.add_argument("--tables", type=int, default=20, help="tables created by the DDL benchmarks")
+    parser.add_argument("--workers", type=int, default=4, help="workers of the parallel load")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark (the best one counts)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", help="directory for the generated exports (a temporary one by default)")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="benchmarks to run (all by default)")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="JSON results of a baseline run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="with --compare, exit with status 1 if a benchmark is this many times slower")
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to " + args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
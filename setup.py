@@ -10,9 +10,17 @@ setuptools.setup(
     author_email="rpan33@wisc.edu",
     description="A set of functions that interacts with a database. It contains some basic functionalities along with some other Dairy-Brain-specific functionalities.",
     install_requires=[
-        'SQLAlchemy',
+        'SQLAlchemy>=1.4.33,<2.0',
         'sqlalchemy_utils'
         ],
+    extras_require={
+        'aio': ['asyncpg'],
+        'numpy': ['numpy'],
+        'zstd': ['zstandard'],
+        },
+    entry_points={
+        'console_scripts': ['dairybrain-load=DairyBrainUtils.ingest:main'],
+        },
     long_description=long_description,
     long_description_content_type="text/markdown",
     url="https://github.com/DairyBrain/AgDH_DairyBrainUtils",
@@ -22,5 +30,5 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
 )
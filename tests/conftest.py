@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+import DairyBrainUtils as dbu
+
+
+SCHEMA = "dairybrainutils_test"
+
+
+@pytest.fixture
+def db_engine():
+    """
+    Engine for the database given by the standard PG* environment variables, with an empty test schema; the tests
+    that need a database are skipped if PGHOST isn't set
+    """
+    if "PGHOST" not in os.environ:
+        pytest.skip("PGHOST is not set")
+    db_engine = dbu.get_engine(dict(
+        dialect="postgresql",
+        user=os.environ.get("PGUSER", "postgres"),
+        password=os.environ.get("PGPASSWORD", ""),
+        host=os.environ["PGHOST"],
+        port=os.environ.get("PGPORT", "5432"),
+        db_name=os.environ.get("PGDATABASE", "postgres"),
+        log=False,
+    ))
+    db_engine.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0};".format(SCHEMA))
+    yield db_engine
+    db_engine.execute("DROP SCHEMA IF EXISTS {} CASCADE;".format(SCHEMA))
@@ -0,0 +1,48 @@
+import asyncio
+import os
+
+import pytest
+
+from conftest import SCHEMA
+import DairyBrainUtils as dbu
+
+dbu_aio = pytest.importorskip("DairyBrainUtils.aio")
+
+
+def credentials():
+    return dict(dialect="postgresql", user=os.environ.get("PGUSER", "postgres"),
+                password=os.environ.get("PGPASSWORD", ""), host=os.environ["PGHOST"],
+                port=os.environ.get("PGPORT", "5432"), db_name=os.environ.get("PGDATABASE", "postgres"), log=False)
+
+
+def test_engines_per_event_loop(db_engine):
+    async def engine_twice():
+        first = dbu_aio.get_engine(credentials())
+        assert dbu_aio.get_engine(credentials()) is first
+        async with first.connect() as con:
+            await con.exec_driver_sql("SELECT 1")
+        await first.dispose()  # its connections belong to this loop, which asyncio.run closes
+        return first
+
+    first = asyncio.run(engine_twice())
+    # a second loop can't use the first loop's connections, so it gets an engine of its own
+    second = asyncio.run(engine_twice())
+    assert first is not second
+
+
+def test_populate_table_from_stream_in_target_schema(db_engine):
+    db_engine.execute("CREATE TABLE {}.animals (id integer, name text);".format(SCHEMA))
+
+    async def rows():
+        yield b"1,a\n2,b\n"
+
+    async def load():
+        db_engine_aio = dbu_aio.get_engine(credentials())
+        try:
+            with dbu.target_schema(SCHEMA):
+                return await dbu_aio.populate_table_from_stream("animals", rows(), db_engine_aio)
+        finally:
+            await dbu_aio.dispose_all()
+
+    assert asyncio.run(load()) == 2
+    assert db_engine.execute("SELECT count(*) FROM {}.animals;".format(SCHEMA)).scalar() == 2
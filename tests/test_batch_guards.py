@@ -0,0 +1,67 @@
+import csv
+
+import pytest
+
+from conftest import SCHEMA
+import DairyBrainUtils as dbu
+
+
+def write_rows(path, n):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name"])
+        writer.writerows([i, "cow %d" % i] for i in range(n))
+
+
+def test_bulk_load_in_batch(db_engine, tmp_path):
+    table = SCHEMA + ".animals"
+    csv_file = tmp_path / "animals.csv"
+    write_rows(csv_file, 100)
+    with dbu.batch(db_engine):
+        dbu.create_table(db_engine, table, "CREATE TABLE {} (id integer PRIMARY KEY, name text);")
+        assert dbu.bulk_load(table, str(csv_file), db_engine) == 100
+    assert db_engine.execute("SELECT count(*) FROM {};".format(table)).scalar() == 100
+
+
+def test_load_files_in_batch_exits(db_engine, tmp_path):
+    csv_file = tmp_path / "animals.csv"
+    write_rows(csv_file, 10)
+    with pytest.raises(SystemExit):
+        with dbu.batch(db_engine):
+            dbu.load_files(SCHEMA + ".animals", [str(csv_file)], db_engine, manifest_table=SCHEMA + ".manifest")
+
+
+def test_export_table_to_csv_in_batch(db_engine, tmp_path):
+    table = SCHEMA + ".animals"
+    csv_file = tmp_path / "animals.csv"
+    with dbu.batch(db_engine):
+        dbu.create_table(db_engine, table, "CREATE TABLE {} (id integer, name text);")
+        # only the batch's connection can see these rows until it commits
+        dbu.execute_statement("INSERT INTO {} VALUES (1, 'a'), (2, 'b');".format(table), db_engine)
+        result = dbu.export_table_to_csv(table, str(csv_file), db_engine, workers=4)
+    assert result == {"files": [str(csv_file)], "rows": 2}
+    assert csv_file.read_text() == "id,name\n1,a\n2,b\n"
+
+
+@pytest.mark.parametrize("key_column", ["id", None])
+def test_export_table_to_csv_in_ranges(db_engine, tmp_path, key_column):
+    table = SCHEMA + ".animals"
+    csv_file = tmp_path / "animals.csv"
+    db_engine.execute("CREATE TABLE {} (id integer, name text);".format(table))
+    db_engine.execute("INSERT INTO {} SELECT i, 'cow ' || i FROM generate_series(1, 1000) i;".format(table))
+    result = dbu.export_table_to_csv(table, str(csv_file), db_engine, workers=3, key_column=key_column)
+    assert result == {"files": [str(csv_file)], "rows": 1000}
+    lines = csv_file.read_text().splitlines()
+    assert lines[0] == "id,name"
+    assert sorted(lines[1:], key=lambda line: int(line.split(",")[0])) == ["%d,cow %d" % (i, i) for i in range(1, 1001)]
+
+
+def test_export_table_to_csv_sharded(db_engine, tmp_path):
+    table = SCHEMA + ".animals"
+    db_engine.execute("CREATE TABLE {} (id integer, name text);".format(table))
+    db_engine.execute("INSERT INTO {} SELECT i, 'cow ' || i FROM generate_series(1, 100) i;".format(table))
+    result = dbu.export_table_to_csv(table, str(tmp_path / "animals.csv"), db_engine, workers=2, key_column="id",
+                                     sharded=True)
+    assert result["files"] == [str(tmp_path / "animals.part000.csv"), str(tmp_path / "animals.part001.csv")]
+    assert result["rows"] == 100
+    assert all(open(f).readline() == "id,name\n" for f in result["files"])
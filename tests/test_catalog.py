@@ -0,0 +1,39 @@
+from conftest import SCHEMA
+import DairyBrainUtils as dbu
+
+
+def test_catalog_resolves_plain_names_on_search_path(db_engine):
+    db_engine.execute("CREATE TABLE public.dairybrainutils_shadowed (id integer);")
+    dbu.cache_catalog(db_engine)
+    try:
+        catalog = dbu._catalogs[id(db_engine)]
+        catalog.search_path = [SCHEMA, "public"]  # as if the engine's search_path started with the test schema
+        dbu._update_catalog(db_engine, "dairybrainutils_shadowed", True)
+        assert (SCHEMA, "dairybrainutils_shadowed") in catalog.relations
+        # dropping the plain name drops the first one on the search_path; the one in public is still visible
+        dbu._update_catalog(db_engine, "dairybrainutils_shadowed", False)
+        assert (SCHEMA, "dairybrainutils_shadowed") not in catalog.relations
+        assert dbu.has_table("dairybrainutils_shadowed", db_engine)
+        dbu._update_catalog(db_engine, "public.dairybrainutils_shadowed", False)
+        assert not dbu.has_table("dairybrainutils_shadowed", db_engine)
+        assert not catalog.stale
+    finally:
+        dbu.uncache_catalog(db_engine)
+        db_engine.execute("DROP TABLE public.dairybrainutils_shadowed;")
+
+
+def test_execute_statement_updates_cached_catalog(db_engine):
+    dbu.cache_catalog(db_engine)
+    try:
+        catalog = dbu._catalogs[id(db_engine)]
+        dbu.execute_statement("CREATE TABLE IF NOT EXISTS {0}.a (id integer); CREATE VIEW {0}.b AS SELECT 1;".format(
+            SCHEMA), db_engine)
+        assert dbu.tables_exist([SCHEMA + ".a", SCHEMA + ".b"], db_engine) == [True, True]
+        dbu.execute_statement("DROP VIEW {0}.b; DROP TABLE {0}.a;".format(SCHEMA), db_engine)
+        assert dbu.tables_exist([SCHEMA + ".a", SCHEMA + ".b"], db_engine) == [False, False]
+        assert not catalog.stale
+        dbu.execute_statement("ALTER TABLE IF EXISTS {}.a RENAME TO c;".format(SCHEMA), db_engine)
+        assert catalog.stale
+    finally:
+        dbu.uncache_catalog(db_engine)
+    assert id(db_engine) not in dbu._catalogs
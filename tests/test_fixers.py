@@ -0,0 +1,112 @@
+import csv
+
+import DairyBrainUtils as dbu
+
+
+ANIMAL_HEADER = ["ID", "PEN", "LACT", "DIM", "BDAT", "FDAT", "CDAT", "DDAT", "SID", "DAM", "EID", "RC", "TBRD",
+                 "HDAT", "XDAT", "REMARK", ""]
+EVENT_HEADER = ["ID", "PEN", "LACT", "DIM", "EVENT", "DATE", "TECH", "BREED", "REMARK", "PROTOCOL", ""]
+
+
+def animal_row(animal_id, remark):
+    return [animal_id, "1", "2", "100", "1/1/20", "2/1/20", "3/1/20", "4/1/20", "SIRE", "DAM", "EID", "5", "0",
+            "5/1/20", "6/1/20"] + remark + [""]
+
+
+def event_row(animal_id, remark):
+    return [animal_id, "1", "2", "100", "BRED", "1/1/20", "T1", "HO"] + remark + ["P1", ""]
+
+
+def write_csv(path, rows):
+    with open(path, "w", newline="") as f:
+        csv.writer(f).writerows(rows)
+
+
+def read_csv(path):
+    with open(path, newline="") as f:
+        return list(csv.reader(f))
+
+
+def test_fold_remark_joins_extra_columns():
+    row = ["a", "b", "first part", " second", " third", "c"]
+    assert dbu._fold_remark(row, 4, 2) == ["a", "b", "first part  second third", "c"]
+
+
+def test_fold_remark_leaves_well_formed_row():
+    row = ["a", "b", "remark", "c"]
+    assert dbu._fold_remark(row, 4, 2) == ["a", "b", "remark", "c"]
+
+
+def test_shrink_animal_row_folds_into_remark_column():
+    row = animal_row("1", ["sold", " lame", " old"])[:-1]
+    dbu.shrink_animal_row(row, 16)
+    assert len(row) == 16
+    assert row[15] == "sold  lame old"
+    assert row[8] == "SIRE"
+
+
+def test_shrink_row_folds_into_remark_column():
+    row = event_row("1", ["bred", " twice"])[:-1]
+    dbu.shrink_row(row, 10)
+    assert row == ["1", "1", "2", "100", "BRED", "1/1/20", "T1", "HO", "bred  twice", "P1"]
+
+
+def test_fix_animal_file(tmp_path):
+    in_file, out_file = tmp_path / "animals.csv", tmp_path / "animals.fixed"
+    write_csv(in_file, [ANIMAL_HEADER,
+                        animal_row(" 1 ", [" ok "]),
+                        animal_row("2", ["sold", " lame"]),
+                        ["Total", "2", ""]])
+    dbu.fix_animal_file(str(in_file), str(out_file))
+    rows = read_csv(out_file)
+    assert rows[0] == ANIMAL_HEADER[:-1]
+    assert rows[1] == animal_row("1", ["ok"])[:-1]
+    assert rows[2] == animal_row("2", ["sold  lame"])[:-1]
+    assert len(rows) == 3
+
+
+def test_fix_event_file_quoted_values(tmp_path):
+    in_file, out_file = tmp_path / "events.csv", tmp_path / "events.fixed"
+    write_csv(in_file, [EVENT_HEADER, event_row("1", ["a, quoted\nremark"]), event_row("2", ["plain"])])
+    dbu.fix_event_file(str(in_file), str(out_file))
+    assert read_csv(out_file) == [EVENT_HEADER[:-1],
+                                  event_row("1", ["a, quoted\nremark"])[:-1],
+                                  event_row("2", ["plain"])[:-1]]
+
+
+def test_fix_event_file_rejects_short_rows(tmp_path):
+    in_file, out_file, reject_file = tmp_path / "events.csv", tmp_path / "events.fixed", tmp_path / "rejects.csv"
+    write_csv(in_file, [EVENT_HEADER, ["1", "short", ""], event_row("2", ["plain"])])
+    dbu.fix_event_file(str(in_file), str(out_file), reject_filename=str(reject_file))
+    assert read_csv(out_file) == [EVENT_HEADER[:-1], event_row("2", ["plain"])[:-1]]
+    assert read_csv(reject_file) == [["1", "short"]]
+
+
+def test_fix_rows_matches_fix_file(tmp_path):
+    in_file, out_file = tmp_path / "events.csv", tmp_path / "events.fixed"
+    rows = [EVENT_HEADER, event_row(" 1", ["x", "y"]), event_row("2", ["a,b"])]
+    write_csv(in_file, rows)
+    dbu.fix_event_file(str(in_file), str(out_file))
+    with open(in_file, newline="") as f:
+        assert list(dbu.fix_event_rows(csv.reader(f))) == read_csv(out_file)
+
+
+def test_row_stream_matches_fix_file(tmp_path):
+    in_file, out_file, side_file = tmp_path / "events.csv", tmp_path / "events.fixed", tmp_path / "events.side"
+    rows = [EVENT_HEADER] + [event_row(str(i), ["remark %d" % i, " more"] if i % 3 else ["a, quoted\nremark"])
+                             for i in range(50)]
+    write_csv(in_file, rows)
+    dbu.fix_event_file(str(in_file), str(out_file))
+
+    with open(in_file, newline="") as f, open(side_file, "w", newline="") as side_output:
+        stream = dbu.RowStream(dbu.fix_event_rows(csv.reader(f)), side_output=side_output)
+        # mix readline() with small reads, as copy_expert does, so pieces end mid-row and mid-line
+        pieces = [stream.readline(), stream.readline(5)]
+        while pieces[-1]:
+            pieces.append(stream.read(7) if len(pieces) % 2 else stream.readline())
+        assert stream.read() == "" and stream.readline() == ""
+
+    with open(out_file, newline="") as f:
+        f.readline()  # RowStream skips the header
+        assert "".join(pieces) == f.read()
+    assert side_file.read_bytes() == out_file.read_bytes()
@@ -0,0 +1,111 @@
+import os
+
+import pytest
+
+from conftest import SCHEMA
+from DairyBrainUtils import ingest
+
+
+def touch(path, content="ID,PEN,\n1,2,\n"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    return str(path)
+
+
+def test_file_type():
+    assert ingest.file_type("events_5.csv") == 5
+    assert ingest.file_type("/data/farm a/animals_1.csv.gz") == 1
+    assert ingest.file_type("animals.csv") is None
+
+
+def test_find_exports(tmp_path):
+    animals = touch(tmp_path / "farm_b" / "animals_1.csv")
+    events = touch(tmp_path / "farm_a" / "events_5.csv.gz")
+    touch(tmp_path / "farm_a" / "events_5.csv.gz.fixed")  # output of an earlier run
+    touch(tmp_path / "farm_a" / "events_5.csv.gz.rejects")
+    touch(tmp_path / "farm_a" / "notes.txt")
+    touch(tmp_path / "readme.csv")  # not in a farm directory
+    assert ingest.find_exports(str(tmp_path)) == [ingest.Export("farm_a", events, 5),
+                                                  ingest.Export("farm_b", animals, 1)]
+
+
+def test_read_manifest(tmp_path):
+    absolute = str(tmp_path / "elsewhere" / "herd.csv")
+    manifest = tmp_path / "lists" / "manifest.csv"
+    touch(manifest, "farm,file,type\nA,exports/events_6.csv,\nB,{},2\n".format(absolute))
+    assert ingest.read_manifest(str(manifest)) == [
+        ingest.Export("A", os.path.join(str(tmp_path / "lists"), "exports/events_6.csv"), 6),
+        ingest.Export("B", absolute, 2)]
+
+
+def test_read_manifest_without_type_column(tmp_path):
+    manifest = touch(tmp_path / "manifest.csv", "farm,file\nA,animals_1.csv\n")
+    assert ingest.read_manifest(manifest) == [ingest.Export("A", str(tmp_path / "animals_1.csv"), 1)]
+
+
+@pytest.mark.parametrize("content", ["farm,file,type\nA,events_5.csv,3\n", "farm,file\nA,events.csv\n"])
+def test_read_manifest_bad_type(tmp_path, content):
+    manifest = touch(tmp_path / "manifest.csv", content)
+    with pytest.raises(ValueError):
+        ingest.read_manifest(manifest)
+
+
+def test_schema_name():
+    assert ingest.schema_name(" Green Acres ") == "green_acres"
+    assert ingest.schema_name("O'Brien-Farm #2") == "o_brien_farm__2"
+    assert ingest.schema_name("4H Club") == "farm_4h_club"
+    assert ingest.schema_name("4H Club", prefix="dairy_") == "dairy_4h_club"
+
+
+def test_table_ddl(tmp_path):
+    fixed = touch(tmp_path / "events_5.csv.fixed", "ID,PEN,DIM,Event Date,DIM,DIM,\"\"\n1,2,3,4,5,6,\n")
+    assert ingest.table_ddl(fixed) == (
+        'CREATE TABLE {} ("id" text, "pen" text, "dim" text, "event_date" text, "dim_2" text, "dim_3" text, '
+        '"column" text);')
+
+
+def test_main_arguments(tmp_path, monkeypatch):
+    touch(tmp_path / "farm_a" / "events_5.csv")
+    calls = []
+
+    def load_farms(exports, credentials, **options):
+        calls.append((exports, credentials, options))
+        return [{"status": "loaded"}]
+
+    monkeypatch.setattr(ingest, "load_farms", load_farms)
+    ingest.main([str(tmp_path), "--host", "db", "--port", "5433", "--user", "u", "--db-name", "herds",
+                 "--load-workers", "2", "--append", "--compress-fixed", "--max-rejects", "10", "--quiet"])
+    exports, credentials, options = calls[0]
+    assert exports == [ingest.Export("farm_a", str(tmp_path / "farm_a" / "events_5.csv"), 5)]
+    assert (credentials["host"], credentials["port"], credentials["user"], credentials["db_name"]) == (
+        "db", "5433", "u", "herds")
+    assert options["load_workers"] == 2 and options["replace"] is False and options["max_rejects"] == 10
+    assert options["fixed_suffix"] == ".fixed.gz"
+
+
+def test_main_exits_when_an_export_fails(tmp_path, monkeypatch):
+    manifest = touch(tmp_path / "manifest.csv", "farm,file\nA,events_5.csv\n")
+    monkeypatch.setattr(ingest, "load_farms", lambda exports, credentials, **options: [{"status": "failed"}])
+    with pytest.raises(SystemExit) as exit_info:
+        ingest.main([manifest, "--quiet"])
+    assert exit_info.value.code == 1
+
+
+def test_load_farms(db_engine, tmp_path):
+    header = "ID,PEN,LACT,DIM,EVENT,DATE,TECH,BREED,REMARK,PROTOCOL,\n"
+    touch(tmp_path / "Farm A" / "events_5.csv",
+          header + "1,1,2,100,BRED,1/1/20,T1,HO,ok,P1,\n2,1,2,100,BRED,1/2/20,T1,HO,a,b,P1,\n")
+    touch(tmp_path / "Farm B" / "events_5.csv", header + "3,1,2,100,BRED,1/1/20,T1,HO,,P1,\n")
+    credentials = dict(db_engine.url.translate_connect_args(database="db_name", username="user"),
+                       dialect="postgresql", log=False)
+    credentials.setdefault("password", "")
+    credentials.setdefault("port", 5432)
+    results = ingest.load_farms(ingest.find_exports(str(tmp_path)), credentials, fix_workers=1, load_workers=2,
+                                schema_prefix=SCHEMA + "_", fixed_dir=str(tmp_path / "fixed"))
+    try:
+        assert [(result["table"], result["status"], result["rows"]) for result in results] == [
+            (SCHEMA + "_farm_a.events", "loaded", 2), (SCHEMA + "_farm_b.events", "loaded", 1)]
+        assert db_engine.execute("SELECT remark FROM {}_farm_a.events WHERE id = '2';".format(SCHEMA)).scalar() == "a b"
+    finally:
+        for farm in ("farm_a", "farm_b"):
+            db_engine.execute("DROP SCHEMA IF EXISTS {}_{} CASCADE;".format(SCHEMA, farm))
@@ -0,0 +1,119 @@
+import datetime
+import struct
+
+import DairyBrainUtils as dbu
+
+
+def test_split_csv_ranges_hold_whole_rows(tmp_path):
+    csv_file = tmp_path / "events.csv"
+    rows = ['{},"remark {}\nwith a newline",x\n'.format(i, i) if i % 3 == 0 else "{},plain,x\n".format(i)
+            for i in range(200)]
+    data = ("id,remark,flag\n" + "".join(rows)).encode()
+    csv_file.write_bytes(data)
+
+    ranges = dbu._split_csv(str(csv_file), 4, block_size=64)
+
+    assert len(ranges) == 4
+    assert ranges[0][0] == len(b"id,remark,flag\n") and ranges[-1][1] == len(data)
+    assert all(ranges[i][1] == ranges[i + 1][0] for i in range(len(ranges) - 1))
+    row_starts = {len("id,remark,flag\n".encode()) + len("".join(rows[:i]).encode()) for i in range(len(rows))}
+    assert all(start in row_starts for start, end in ranges)
+
+
+def test_split_csv_from_offset(tmp_path):
+    csv_file = tmp_path / "events.csv"
+    csv_file.write_bytes(b"id\n" + b"".join(b"%d\n" % i for i in range(100)))
+    start = len(b"id\n") + len(b"".join(b"%d\n" % i for i in range(50)))
+    ranges = dbu._split_csv(str(csv_file), 2, start=start)
+    assert ranges[0][0] == start and ranges[-1][1] == csv_file.stat().st_size
+
+
+def test_values_clause():
+    statement = "INSERT INTO t (a, b) VALUES (%(a)s, lower(%(b)s)) ON CONFLICT DO NOTHING"
+    assert dbu._values_clause(statement) == ("INSERT INTO t (a, b) VALUES ", "(%(a)s, lower(%(b)s))",
+                                             " ON CONFLICT DO NOTHING")
+
+
+def test_values_clause_ignores_parentheses_in_strings():
+    statement = "INSERT INTO t VALUES (%(a)s, ')(', %(b)s)"
+    assert dbu._values_clause(statement)[1] == "(%(a)s, ')(', %(b)s)"
+
+
+def test_values_clause_other_statements():
+    assert dbu._values_clause("UPDATE t SET a = %(a)s") is None
+    assert dbu._values_clause("INSERT INTO t SELECT * FROM u") is None
+    assert dbu._values_clause("INSERT INTO t VALUES (1), (2)") is None
+
+
+def read_binary_copy(data, columns):
+    """
+    Decodes PostgreSQL's binary COPY format, for integer, date and text columns
+    """
+    assert data[:11] == b"PGCOPY\n\xff\r\n\x00"
+    position = 19  # signature, flags and header extension length
+    rows = []
+    while True:
+        field_count, = struct.unpack_from("!h", data, position)
+        position += 2
+        if field_count == -1:
+            assert position == len(data)
+            return rows
+        assert field_count == len(columns)
+        row = []
+        for column_type in columns:
+            length, = struct.unpack_from("!i", data, position)
+            position += 4
+            if length == -1:
+                row.append(None)
+                continue
+            value = data[position:position + length]
+            position += length
+            if column_type == "integer":
+                row.append(struct.unpack("!i", value)[0])
+            elif column_type == "date":
+                row.append(datetime.date(2000, 1, 1) + datetime.timedelta(days=struct.unpack("!i", value)[0]))
+            else:
+                row.append(value.decode())
+        rows.append(tuple(row))
+
+
+def test_binary_copy_stream():
+    columns = ["integer", "date", "text"]
+    rows = [(i, datetime.date(1999, 12, 31) + datetime.timedelta(days=i), None if i % 4 == 0 else "cow %d" % i)
+            for i in range(25)]
+    stream = dbu._BinaryCopyStream(rows, [dbu._binary_encoders[column] for column in columns], rows_per_block=7)
+    # read in small pieces, as copy_expert does, across several blocks
+    data = b"".join(iter(lambda: stream.read(13), b""))
+    assert read_binary_copy(data, columns) == rows
+    assert stream.count == 25
+
+
+def test_binary_copy_stream_without_rows():
+    stream = dbu._BinaryCopyStream([], [dbu._binary_encoders["integer"]])
+    assert read_binary_copy(stream.read(), ["integer"]) == []
+
+
+def test_encode_timestamp():
+    value = datetime.datetime(2000, 1, 2, 0, 0, 1, 5)
+    assert dbu._encode_timestamp(value) == struct.pack("!iq", 8, 86401000005)
+
+
+def test_partition_intervals():
+    assert dbu._interval_start(datetime.date(2020, 2, 29), "day") == datetime.date(2020, 2, 29)
+    assert dbu._interval_start(datetime.date(2020, 2, 29), "month") == datetime.date(2020, 2, 1)
+    assert dbu._interval_start(datetime.date(2020, 2, 29), "year") == datetime.date(2020, 1, 1)
+    next_month = dbu._partition_intervals["month"][1]
+    assert next_month(datetime.date(2020, 1, 1)) == datetime.date(2020, 2, 1)
+    assert next_month(datetime.date(2020, 12, 1)) == datetime.date(2021, 1, 1)
+    assert dbu._partition_intervals["day"][1](datetime.date(2020, 2, 28)) == datetime.date(2020, 2, 29)
+    assert dbu._partition_intervals["year"][1](datetime.date(2020, 1, 1)) == datetime.date(2021, 1, 1)
+
+
+def test_partition_bounds():
+    assert dbu._range_bounds("FOR VALUES FROM ('2020-01-01') TO ('2020-02-01')") == (
+        datetime.date(2020, 1, 1), datetime.date(2020, 2, 1))
+    assert dbu._range_bounds("FOR VALUES FROM (MINVALUE) TO ('2020-01-01 00:00:00')") == (
+        None, datetime.date(2020, 1, 1))
+    assert dbu._range_bounds("DEFAULT") is None
+    assert dbu._list_values("FOR VALUES IN ('42', '43')") == ["42", "43"]
+    assert dbu._partition_name("dairy_comp.events", "herd-42") == "dairy_comp.events_herd_42"
@@ -0,0 +1,121 @@
+import bz2
+import csv
+import gzip
+
+import pytest
+
+from conftest import SCHEMA
+import DairyBrainUtils as dbu
+
+
+def write_rows(path, n):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name"])
+        writer.writerows([i, "cow %d" % i] for i in range(n))
+
+
+def test_bulk_load_restores_indexes_and_analyzes(db_engine, tmp_path):
+    table = SCHEMA + ".animals"
+    db_engine.execute("CREATE TABLE {} (id integer PRIMARY KEY, name text);".format(table))
+    db_engine.execute("CREATE INDEX animals_name ON {} (name);".format(table))
+    csv_file = tmp_path / "animals.csv"
+    write_rows(csv_file, 500)
+
+    assert dbu.bulk_load(table, str(csv_file), db_engine, workers=2) == 500
+
+    indexes = db_engine.execute("SELECT indexname FROM pg_indexes WHERE schemaname = %s ORDER BY 1;",
+                                (SCHEMA,)).fetchall()
+    assert [row[0] for row in indexes] == ["animals_name", "animals_pkey"]
+    assert db_engine.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass;", (table,)).scalar() == 500
+    assert db_engine.execute("SELECT relpersistence FROM pg_class WHERE oid = %s::regclass;", (table,)).scalar() == "p"
+
+
+def test_target_schema_doesnt_stay_on_pooled_connections(db_engine, tmp_path):
+    default = db_engine.execute("SHOW search_path;").scalar()
+    db_engine.execute("CREATE TABLE {}.animals (id integer PRIMARY KEY, name text);".format(SCHEMA))
+    db_engine.execute("CREATE INDEX animals_name ON {}.animals (name);".format(SCHEMA))
+    csv_file = tmp_path / "animals.csv"
+    write_rows(csv_file, 10)
+    with dbu.target_schema(SCHEMA):
+        assert dbu.populate_table_from_csv("animals", str(csv_file), db_engine) == 10
+        db_engine.execute("TRUNCATE {}.animals;".format(SCHEMA))
+        # bulk_load commits several times, and builds the indexes on other connections
+        assert dbu.bulk_load("animals", str(csv_file), db_engine) == 10
+    # every checkout after the loads sees the server's search_path again
+    assert all(db_engine.execute("SHOW search_path;").scalar() == default for _ in range(5))
+
+
+def test_populate_table_from_csv_parallel(db_engine, tmp_path):
+    table = SCHEMA + ".animals"
+    db_engine.execute("CREATE TABLE {} (id integer, name text);".format(table))
+    csv_file = tmp_path / "animals.csv"
+    write_rows(csv_file, 1000)
+    stats = dbu.populate_table_from_csv_parallel(table, str(csv_file), db_engine, workers=3)
+    assert sum(worker["rows"] for worker in stats) == 1000
+    assert db_engine.execute("SELECT count(*) FROM {};".format(table)).scalar() == 1000
+
+
+def test_populate_table_from_csv_parallel_header_only(db_engine, tmp_path):
+    table = SCHEMA + ".animals"
+    db_engine.execute("CREATE TABLE {} (id integer, name text);".format(table))
+    csv_file = tmp_path / "animals.csv"
+    write_rows(csv_file, 0)
+    assert dbu.populate_table_from_csv_parallel(table, str(csv_file), db_engine, workers=3) == []
+
+
+def write_gzip_rows(path, n):
+    with gzip.open(path, "wt", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name"])
+        writer.writerows([i, "cow %d" % i] for i in range(n))
+
+
+def test_populate_table_from_csv_parallel_compressed(db_engine, tmp_path):
+    table = SCHEMA + ".animals"
+    db_engine.execute("CREATE TABLE {} (id integer, name text);".format(table))
+    csv_file = tmp_path / "animals.csv.gz"
+    write_gzip_rows(csv_file, 1000)
+    stats = dbu.populate_table_from_csv_parallel(table, str(csv_file), db_engine, workers=3)
+    assert [worker["rows"] for worker in stats] == [1000]
+
+
+def test_load_files_compressed(db_engine, tmp_path):
+    table = SCHEMA + ".animals"
+    db_engine.execute("CREATE TABLE {} (id integer, name text);".format(table))
+    csv_file = tmp_path / "animals.csv.gz"
+    write_gzip_rows(csv_file, 1000)
+    manifest = SCHEMA + ".manifest"
+    result = dbu.load_files(table, [str(csv_file)], db_engine, manifest_table=manifest, chunk_size=1000)
+    assert [(file["status"], file["rows"]) for file in result] == [("loaded", 1000)]
+    result = dbu.load_files(table, [str(csv_file)], db_engine, manifest_table=manifest, chunk_size=1000)
+    assert [file["status"] for file in result] == ["skipped"]
+    assert db_engine.execute("SELECT count(*) FROM {};".format(table)).scalar() == 1000
+
+
+@pytest.mark.parametrize("extension, open_file", [(".gz", gzip.open), (".bz2", bz2.open)])
+def test_export_table_to_csv_compressed(db_engine, tmp_path, extension, open_file):
+    table = SCHEMA + ".animals"
+    db_engine.execute("CREATE TABLE {} (id integer, name text);".format(table))
+    db_engine.execute("INSERT INTO {} SELECT i, 'cow ' || i FROM generate_series(1, 100) i;".format(table))
+    csv_file = tmp_path / ("animals.csv" + extension)
+    dbu.export_table_to_csv(table, str(csv_file), db_engine, workers=2, key_column="id")
+    with open_file(csv_file, "rt") as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "id,name" and len(lines) == 101
+
+
+def test_fix_and_populate_table(db_engine, tmp_path):
+    table = SCHEMA + ".events"
+    db_engine.execute("CREATE TABLE {} (id text, pen text, lact text, dim text, event text, date text, tech text, "
+                      "breed text, remark text, protocol text);".format(table))
+    in_file, fixed_file = tmp_path / "events.csv", tmp_path / "events.fixed"
+    with open(in_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["ID", "PEN", "LACT", "DIM", "EVENT", "DATE", "TECH", "BREED", "REMARK", "PROTOCOL", ""])
+        writer.writerows([str(i), "1", "2", "100", "BRED", "1/1/20", "T1", "HO", "bred", " twice", "P1", ""]
+                         for i in range(25))
+
+    assert dbu.fix_and_populate_table(table, str(in_file), 5, db_engine, fixed_filename=str(fixed_file)) == 25
+    assert db_engine.execute("SELECT count(*) FROM {} WHERE remark = 'bred  twice';".format(table)).scalar() == 25
+    assert len(fixed_file.read_text().splitlines()) == 26
@@ -0,0 +1,20 @@
+import datetime
+
+from conftest import SCHEMA
+import DairyBrainUtils as dbu
+
+
+def test_populate_partitioned_table_from_csv(db_engine, tmp_path):
+    table = SCHEMA + ".events"
+    dbu.create_table(db_engine, table, "CREATE TABLE {} (id integer, remark text, event_date date);",
+                     partition_by="RANGE (event_date)")
+    dbu.create_range_partitions(db_engine, table, datetime.date(2020, 1, 1), datetime.date(2020, 1, 31))
+    csv_file = tmp_path / "events.csv"
+    # the key comes after a remark with an escaped comma, as COPY's text format writes it
+    csv_file.write_text("id,remark,event_date\n1,plain,2020-01-05\n2,a\\, b,2020-03-05\n3,,2020-03-20\n")
+
+    rows = dbu.populate_partitioned_table_from_csv(table, str(csv_file), db_engine)
+
+    assert rows == {table + "_202001": 1, table + "_202003": 2}
+    assert db_engine.execute("SELECT count(*) FROM {}_202003;".format(table)).scalar() == 2
+    assert db_engine.execute("SELECT remark FROM {} WHERE id = 2;".format(table)).scalar() == "a, b"
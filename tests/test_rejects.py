@@ -0,0 +1,26 @@
+import csv
+
+from conftest import SCHEMA
+import DairyBrainUtils as dbu
+
+
+def test_populate_table_from_csv_with_many_rejects(db_engine, tmp_path):
+    table = SCHEMA + ".counts"
+    db_engine.execute("CREATE TABLE {} (id integer, n integer NOT NULL);".format(table))
+    csv_file, reject_file = tmp_path / "counts.csv", tmp_path / "counts.rejects"
+    rows = [["id", "n"]]
+    for i in range(1000):
+        # every tenth row refused: 100 of them, more than the 64 subtransactions a backend keeps track of
+        rows.append([i, "bad" if i % 10 == 0 else i])
+    with open(csv_file, "w", newline="") as f:
+        csv.writer(f).writerows(rows)
+
+    counts = dbu.populate_table_from_csv(table, str(csv_file), db_engine, max_rejects=100,
+                                         reject_location=str(reject_file), reject_table=SCHEMA + ".rejects",
+                                         batch_rows=64)
+
+    assert counts == {"rows": 900, "rejected": 100}
+    assert db_engine.execute("SELECT count(*) FROM {};".format(table)).scalar() == 900
+    assert db_engine.execute("SELECT count(*) FROM {}.rejects;".format(SCHEMA)).scalar() == 100
+    with open(reject_file) as f:
+        assert [line.split("\t")[0] for line in f] == [str(i + 2) for i in range(0, 1000, 10)]